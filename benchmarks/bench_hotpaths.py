@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+""" Latency, allocation and throughput benchmarks for the sensor hot paths """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Run from the repository root:
+#   python3 -m benchmarks.bench_hotpaths --output bench.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+from pkg_classes import samplebuffer
+from pkg_classes.configmodel import ConfigModel
+from pkg_classes.loggingmodel import setup_logging
+from pkg_classes.simulatednode import SimulatedNode
+from pkg_classes.simulatedsensors import VirtualClock
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOGGING_FILE = os.path.join(HERE, 'simulation', 'logging.ini')
+START_TIME = 1609459200.0
+# samples in a ten minute window at the default ten second interval
+WINDOW_SAMPLES = 60
+
+def node_argv(index):
+    """ sensor.py options for one simulated node """
+    return ['--mqtt', 'simulated', '--location', 'diy/bench/node'+str(index),
+            '--webserver', 'simulated.local', '--spool', ':memory:',
+            '--calibration-state', '']
+
+def measure(method, iterations, setup=None):
+    """ Per call latency in microseconds and traced allocation in bytes """
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter_ns()
+        method()
+        timings.append(time.perf_counter_ns() - start)
+    timings.sort()
+    tracemalloc.start()
+    if setup is not None:
+        setup()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    method()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'iterations': iterations,
+        'mean_us': round(statistics.fmean(timings) / 1000.0, 3),
+        'median_us': round(timings[len(timings) // 2] / 1000.0, 3),
+        'p95_us': round(timings[int(len(timings) * 0.95)] / 1000.0, 3),
+        'min_us': round(timings[0] / 1000.0, 3),
+        'peak_bytes': peak - before,
+        'retained_bytes': after - before
+    }
+
+def hot_paths(iterations):
+    """ Benchmark each stage of one simulated node """
+    clock = VirtualClock(START_TIME)
+    node = SimulatedNode(ConfigModel(node_argv(0)), clock)
+    sensors = {sensor.name: sensor for sensor in node.sensors}
+    bme680 = sensors['bme680']
+    veml7700 = sensors['veml7700']
+
+    def fill_window():
+        """ a full averaging window ready to be averaged """
+        for sensor in node.sensors:
+            sensor.new_samples()
+            for _ in range(WINDOW_SAMPLES):
+                sensor.collect_sample()
+
+    def clear_messages():
+        """ keep the simulated broker log from growing """
+        del node.client.messages[:]
+
+    def publish_all():
+        """ publish every sensor """
+        for sensor in node.sensors:
+            sensor.publish_samples()
+
+    fill_window()
+    results = {
+        'bme680.collect_sample': measure(bme680.collect_sample, iterations, bme680.new_samples),
+        'veml7700.collect_sample': measure(veml7700.collect_sample, iterations,
+                                           veml7700.new_samples),
+        'bme680.average_samples': measure(bme680.average_samples, iterations, fill_window),
+        'veml7700.average_samples': measure(veml7700.average_samples, iterations, fill_window),
+        'bme680.compute_airquality': measure(bme680.compute_airquality, iterations),
+        'publish_samples': measure(publish_all, iterations, clear_messages),
+        'scheduler.pop_due': measure(node.engine.scheduler.pop_due, iterations)
+    }
+    node.django.drain()
+    return results
+
+def throughput(nodes, seconds):
+    """ Simulated nodes each run for seconds of virtual time """
+    fleet = [SimulatedNode(ConfigModel(node_argv(index)), VirtualClock(START_TIME), index)
+             for index in range(nodes)]
+    steps = int(seconds / 10.0)
+    start = time.perf_counter()
+    for node in fleet:
+        node.run(seconds)
+    elapsed = time.perf_counter() - start
+    return {
+        'nodes': nodes,
+        'virtual_seconds': seconds,
+        'wall_seconds': round(elapsed, 3),
+        'node_steps_per_second': round(nodes * steps / elapsed, 1),
+        'realtime_nodes_per_process': int(nodes * seconds / elapsed)
+    }
+
+if __name__ == '__main__':
+    setup_logging(LOGGING_FILE)
+    PARSER = argparse.ArgumentParser('Sensor hot path benchmarks')
+    PARSER.add_argument('--iterations', type=int, default=2000, help='Calls per benchmark')
+    PARSER.add_argument('--nodes', type=int, default=20, help='Simulated nodes for throughput')
+    PARSER.add_argument('--hours', type=float, default=6.0, help='Virtual hours for throughput')
+    PARSER.add_argument('--output', help='Write JSON here instead of stdout')
+    ARGS = PARSER.parse_args()
+
+    REPORT = {
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': samplebuffer.numpy is not None,
+        'hot_paths': hot_paths(ARGS.iterations),
+        'throughput': throughput(ARGS.nodes, ARGS.hours * 3600.0)
+    }
+    if ARGS.output is None:
+        print(json.dumps(REPORT, indent=2))
+    else:
+        with open(ARGS.output, 'w') as output:
+            json.dump(REPORT, output, indent=2)
@@ -26,33 +26,37 @@
 # Many attributes for this complex sensor.
 # pylint: disable=too-many-instance-attributes
 
-import time
-import logging
-import logging.config
+import hashlib
+import json
+import math
+import threading
 
-import board
-import busio
-import adafruit_bme680
+from pkg_classes.atomicfile import write_json
+from pkg_classes.samplebuffer import SampleBuffer
+from pkg_classes.sensorhal import SensorHAL, get_i2c, instance_path
 
-i2c = busio.I2C(board.SCL, board.SDA)
-SENSOR = adafruit_bme680.Adafruit_BME680_I2C(i2c)
-# change this to match the location's pressure (hPa) at sea level
-SENSOR.sea_level_pressure = 1023.0
+# factory trimming read from the chip, it identifies one BME680 from another
+CHIP_ATTRIBUTES = ('_temp_calibration', '_pressure_calibration', '_humidity_calibration',
+                   '_gas_calibration', '_heat_range', '_heat_val', '_sw_err')
 
-# start the message logging process
+# seconds a restarted incremental window may take to fill before it fails
+RESTART_TIMEOUT = 3600.0
 
-class Bme680HAL:
+class Bme680HAL(SensorHAL):
     """ Idle or sleep pattern """
 
-    def __init__(self, logging_file, client, topic):
+    name = 'bme680'
+
+    # datasheet operating ranges, a gas resistance of zero is a failed read
+    limits = {'temperature': (-40.0, 85.0), 'humidity': (0.0, 100.0),
+              'pressure': (300.0, 1100.0), 'gas': (1.0, 1.0e8)}
+    floors = {'temperature': 0.5, 'humidity': 2.0, 'pressure': 0.5, 'gas': 5000.0}
+
+    def __init__(self, client, topic):
         """ create initial conditions and saving display and I2C lock """
-        logging.config.fileConfig(fname=logging_file,
-                          disable_existing_loggers=False)
-        # Get the logger specified in the file
-        self.logger = logging.getLogger(__name__)
-        self.logger.info('Application started')
-        self.client = client
-        self.topic = topic
+        super().__init__(client, topic,
+                         ('temperature', 'humidity', 'pressure', 'gas'),
+                         ('temperature', 'humidity', 'pressure', 'gas', 'airQuality'))
         # set to zero prior to calibration
         self.gas_baseline = 0.0
         # Set the humidity baseline to 40%, an optimal indoor humidity.
@@ -60,55 +64,229 @@ class Bme680HAL:
         # This sets the balance between humidity and gas reading in the
         # calculation of air_quality_score (25:75, humidity:gas)
         self.hum_weighting = 0.25
-        self.data = {}
-        self.averages = {
-            'temperature': 0.0,
-            'humidity': 0.0,
-            'pressure': 0.0,
-            'gas': 0.0,
-            'airQuality': 0.0
-        }
-        self.dict = {
-            'temperature': '0.0',
-            'humidity': '0.0',
-            'pressure': '0.0',
-            'gas': '0.0',
-            'airQuality': '0.0'
-        }
-        self.samples = 0
-        self.new_samples()
-
-    def calibrate(self,):
-        """ calibrate the BME680 sensor using burning logic """
+        # burnin blocks for a full calibration, incremental keeps a rolling
+        # baseline from the normal sample stream
+        self.calibration_mode = "burnin"
+        self.gas_window = SampleBuffer(50)
+        self.gas_decay = 0.05
+        # None keeps the driver default oversampling and filter
+        self.oversample = None
+        # baselines saved across restarts, restored skips the first burn-in
+        self.state_path = None
+        self.state_age = 0.0
+        self.chip = None
+        self.restored = False
+        self.filter_size = None
+        # only one calibration at a time, scheduled or requested
+        self.calibrating = threading.Lock()
+
+    def open_sensor(self,):
+        """ create the BME680 driver on the shared I2C bus """
+        import adafruit_bme680 # pylint: disable=import-outside-toplevel
+        sensor = adafruit_bme680.Adafruit_BME680_I2C(get_i2c(*self.bus))
+        # change this to match the location's pressure (hPa) at sea level
+        sensor.sea_level_pressure = 1023.0
+        return sensor
+
+    def configure(self, config):
+        """ apply the sampling, driver and calibration settings """
+        super().configure(config)
+        self.oversample, self.filter_size = config.get_bme680_settings()
+        if self.sensor is not None:
+            self.apply_settings(self.sensor)
+        self.set_calibration(*config.get_calibration())
+        self.set_state(*config.get_calibration_state())
+
+    def apply_settings(self, sensor):
+        """ write oversampling and IIR filter settings to the driver """
+        if self.oversample is not None:
+            sensor.temperature_oversample = self.oversample[0]
+            sensor.humidity_oversample = self.oversample[1]
+            sensor.pressure_oversample = self.oversample[2]
+        if self.filter_size is not None:
+            sensor.filter_size = self.filter_size
+
+    def set_calibration(self, mode, window, decay):
+        """ Select burnin or incremental calibration, the number of gas
+            readings in the rolling window and the baseline decay factor.
+        """
+        self.calibration_mode = mode
+        self.gas_window = SampleBuffer(window)
+        self.gas_decay = decay
+        self.logger.info("Calibration mode: "+mode)
+
+    def set_state(self, path, max_age):
+        """ Keep the baselines in path, a saved state older than max_age
+            seconds is ignored. None always calibrates from scratch.
+        """
+        self.state_path = path
+        self.state_age = max_age
+
+    def set_instance(self, instance):
+        """ each gateway instance keeps its baselines in its own file """
+        super().set_instance(instance)
+        self.state_path = instance_path(self.state_path, instance)
+
+    def opened(self, sensor):
+        """ restore the saved baselines once the chip can be identified """
+        self.chip = chip_identity(sensor)
+        if self.state_path is not None:
+            self.restore_state()
+
+    def restore_state(self,):
+        """ use the saved baselines when they are recent and from this chip """
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+            gas, humidity = float(state['gas_baseline']), float(state['hum_baseline'])
+            age = self.clock.time() - float(state['timestamp'])
+            chip = state['chip']
+        except FileNotFoundError:
+            self.logger.info("No saved calibration, calibrating from scratch")
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            self.logger.warning("Saved calibration unreadable: "+repr(err))
+            return False
+        if chip != self.chip:
+            self.logger.warning("Saved calibration is from another chip, ignored")
+            return False
+        if not 0.0 <= age <= self.state_age:
+            self.logger.warning("Saved calibration is {0:.1f} hours old, ignored".format(
+                age / 3600.0))
+            return False
+        if not (math.isfinite(gas) and gas > 0.0 and 0.0 < humidity < 100.0):
+            self.logger.warning("Saved calibration out of range, ignored")
+            return False
+        self.gas_baseline, self.hum_baseline = gas, humidity
+        self.restored = True
+        self.logger.info("Calibration restored: gas baseline {0:.1f}, {1:.1f} hours old".format(
+            gas, age / 3600.0))
+        return True
+
+    def save_state(self,):
+        """ write the baselines to the state file """
+        if self.state_path is None or self.gas_baseline <= 0.0:
+            return
+        state = {'sensor': self.name, 'chip': self.chip, 'timestamp': self.clock.time(),
+                 'gas_baseline': self.gas_baseline, 'hum_baseline': self.hum_baseline}
+        try:
+            write_json(self.state_path, state)
+        except OSError as err:
+            self.logger.error("Calibration not saved: "+repr(err))
+
+    def update_baseline(self, gas):
+        """ fold one gas reading into the rolling incremental baseline """
+        self.gas_window.append(gas)
+        window_mean = self.gas_window.mean()
+        if self.gas_baseline == 0.0 or \
+                (len(self.gas_window) < self.gas_window.capacity and not self.restored):
+            # provisional baseline until the window has filled, a restored
+            # baseline is kept and only decays toward the window
+            self.gas_baseline = window_mean
+        else:
+            self.gas_baseline += self.gas_decay * (window_mean - self.gas_baseline)
+
+    def calibrate(self, cancel=None, progress=None):
+        """ calibrate the BME680 sensor using burning logic, or restart the
+            incremental baseline when progress is reported to a job
+        """
+        if not self.calibrating.acquire(blocking=False):
+            self.logger.warning("Calibration skipped, one is already running")
+            return False
+        try:
+            if self.calibration_mode == "incremental":
+                if progress is None:
+                    # scheduled runs only report the rolling baseline
+                    self.logger.info("Calibration: incremental baseline {0:.1f}".format(
+                        self.gas_baseline))
+                    self.save_state()
+                    return True
+                completed = self.restart_baseline(cancel, progress)
+            else:
+                completed = self.burn_in(cancel, progress)
+            if completed:
+                self.save_state()
+            return completed
+        finally:
+            self.calibrating.release()
+
+    def restart_baseline(self, cancel, progress):
+        """ refill the incremental window from the sample stream, the old
+            baseline is restored when the job is cancelled or the window does
+            not fill in time, which raises TimeoutError
+        """
+        window, baseline, restored = self.gas_window, self.gas_baseline, self.restored
+        self.gas_window = SampleBuffer(window.capacity)
+        self.gas_baseline = 0.0
+        self.restored = False
+        self.logger.info("Calibration: incremental baseline restarted")
+        deadline = self.clock.monotonic() + RESTART_TIMEOUT
+        while len(self.gas_window) < self.gas_window.capacity:
+            progress(len(self.gas_window) / self.gas_window.capacity)
+            cancelled = cancel is not None and cancel.is_set()
+            if cancelled or self.clock.monotonic() >= deadline:
+                self.gas_window, self.gas_baseline = window, baseline
+                self.restored = restored
+                if cancelled:
+                    self.logger.info("Calibration cancelled")
+                    return False
+                # the job publishes the failure with this reason
+                raise TimeoutError("no gas samples for {0:.0f} seconds".format(RESTART_TIMEOUT))
+            self.clock.sleep(1.0)
+        self.logger.info("Calibration completed")
+        return True
+
+    def burn_in(self, cancel, progress):
+        """ 250 second gas resistance burn-in, the baseline is the mean of the
+            last 50 readings
+        """
+        sensor = self.get_sensor()
+        if sensor is None:
+            self.logger.error("Calibration skipped, BME680 unavailable")
+            return False
+        if self.restored and progress is None:
+            # a warm restart publishes from the saved baseline right away,
+            # the next scheduled calibration runs the burn-in as usual
+            self.restored = False
+            self.logger.info("Calibration: burn-in skipped, saved baseline in use")
+            return False
         self.logger.info("Calibration: 5 minute gas resistance burn-in")
-        start_time = time.time()
-        curr_time = time.time()
+        start_time = self.clock.time()
+        curr_time = self.clock.time()
         burn_in_time = 250
         burn_in_data = []
         while curr_time - start_time < burn_in_time:
-            curr_time = time.time()
-            burn_in_data.append(SENSOR.gas)
-            time.sleep(5.0)
-        self.gas_baseline = sum(burn_in_data[-50:]) / 50.0
+            if cancel is not None and cancel.is_set():
+                self.logger.info("Calibration cancelled")
+                return False
+            if progress is not None:
+                progress((curr_time - start_time) / burn_in_time)
+            curr_time = self.clock.time()
+            with self.reading:
+                burn_in_data.append(sensor.gas)
+            self.clock.sleep(5.0)
+        recent_data = burn_in_data[-50:]
+        self.gas_baseline = sum(recent_data) / len(recent_data)
+        self.restored = False
         self.logger.info("Calibration completed")
+        return True
+
+    def read_sample(self, sensor):
+        """ capture one data sample, each property is read once and the
+            driver decodes reads within its refresh time from one measurement
+        """
+        return {'temperature': sensor.temperature, 'humidity': sensor.humidity,
+                'pressure': sensor.pressure, 'gas': sensor.gas}
+
+    def add_value(self, key, value):
+        """ accepted gas readings also feed the incremental baseline """
+        super().add_value(key, value)
+        if key == 'gas' and self.calibration_mode == "incremental":
+            self.update_baseline(value)
 
-    def new_samples(self,):
-        """ initialize a new set of samples """
-        self.data = {
-            'temperature': 0.0,
-            'humidity': 0.0,
-            'pressure': 0.0,
-            'gas': 0.0
-        }
-        self.samples = 0
-
-    def collect_sample(self,):
-        """ capture one data sample """
-        self.data['temperature'] += SENSOR.temperature
-        self.data['humidity'] += SENSOR.humidity
-        self.data['pressure'] += SENSOR.pressure
-        self.data['gas'] += SENSOR.gas
-        self.samples += 1
+    def compute_derived(self,):
+        """ air quality is derived from the gas and humidity averages """
+        self.compute_airquality()
 
     def compute_airquality(self,):
         """ compute air quality based on gas and humidity """
@@ -132,47 +310,25 @@ class Bme680HAL:
         # Calculate air_quality_score.
         self.averages['airQuality'] = hum_score + gas_score
 
-    def average_samples(self,):
-        """ compute averages based on number of samples """
-        if self.samples > 0:
-            self.averages['temperature'] = self.data['temperature'] / self.samples
-            self.averages['humidity'] = self.data['humidity'] / self.samples
-            self.averages['pressure'] = self.data['pressure'] / self.samples
-            self.averages['gas'] = self.data['gas'] / self.samples
-            self.compute_airquality()
-        self.new_samples()
-
-    def publish_samples(self,):
-        """ publish data """
-        # convert celcius to fahrenheit
-        fahrenheit = 9.0 / 5.0 * self.averages['temperature'] + 32
-        info = "{0:.1f}".format(fahrenheit)
-        self.dict['temperature'] = info
-        self.client.publish(self.topic+"/temperature", str(info), 0, True)
-        time.sleep(1.0)
-
-        info = "{0:.1f}".format(self.averages['humidity'])
-        self.dict['humidity'] = info
-        self.client.publish(self.topic+"/humidity", str(info), 0, True)
-        time.sleep(1.0)
-
-        # scale pressure for units and display
-        pressure = self.averages['pressure'] / 10.0
-        info = "{0:.1f}".format(pressure)
-        self.dict['pressure'] = info
-        self.client.publish(self.topic+"/pressure", str(info), 0, True)
-        time.sleep(1.0)
-
-        # scale gas for units and display
-        gas = self.averages['gas'] / 1000.0
-        info = "{0:.1f}".format(gas)
-        self.dict['gas'] = info
-        self.client.publish(self.topic+"/gas", str(info), 0, True)
-        time.sleep(1.0)
-
-        info = "{0:.1f}".format(self.averages['airQuality'])
-        self.dict['airQuality'] = info
-        self.client.publish(self.topic+"/airQuality", str(info), 0, True)
+    def display(self, key, value):
+        """ fahrenheit, pressure and gas scaled for display """
+        if key == 'temperature':
+            # convert celcius to fahrenheit
+            return 9.0 / 5.0 * value + 32
+        if key == 'pressure':
+            return value / 10.0
+        if key == 'gas':
+            return value / 1000.0
+        return value
+
+
+def chip_identity(sensor):
+    """ hash of the factory calibration, None when the driver has none """
+    # pylint: disable=protected-access
+    trimming = [getattr(sensor, name, None) for name in CHIP_ATTRIBUTES]
+    if all(value is None for value in trimming):
+        return None
+    return hashlib.sha256(repr(trimming).encode('utf-8')).hexdigest()[:16]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+""" Remote sensor calibration as a cancellable background job """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import threading
+import time
+import logging
+
+class CalibrationJob:
+    """ Handles diy/system/calibrate. START, ON or an empty payload calibrates
+        every sensor on a background thread, CANCEL or OFF stops it. Progress
+        and the outcome are published to the status topic and a request made
+        while a job is running is rejected.
+    """
+
+    def __init__(self, client, status_topic, sensors):
+        """ Publish job status on status_topic """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.status_topic = status_topic
+        self.sensors = sensors
+        self.cancel = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.step = -1
+        self.clock = time
+
+    def set_clock(self, clock):
+        """ Replace the time module, for example with a virtual clock """
+        self.clock = clock
+
+    def handle(self, msg):
+        """ Start or cancel a job from a diy/system/calibrate message """
+        command = msg.payload.decode('utf-8').strip().upper()
+        if command in ('CANCEL', 'OFF'):
+            self.stop()
+        elif command in ('', 'START', 'ON'):
+            self.start()
+        else:
+            self.publish("rejected", reason="unknown command "+command)
+
+    def running(self,):
+        """ True while a job thread is alive """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self,):
+        """ Start a job unless one is already running """
+        with self.lock:
+            if self.running():
+                self.publish("rejected", reason="calibration already running")
+                return False
+            self.cancel.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True, name="calibration")
+            self.thread.start()
+        return True
+
+    def stop(self,):
+        """ Ask a running job to stop, it reports cancelled when it has """
+        if not self.running():
+            self.publish("rejected", reason="no calibration running")
+            return
+        self.logger.info("Calibration cancel requested")
+        self.cancel.set()
+
+    def publish(self, state, **fields):
+        """ Retained JSON status so a late subscriber sees the last outcome """
+        fields.update({'state': state, 'timestamp': self.clock.time()})
+        self.client.publish(self.status_topic, json.dumps(fields), 1, True)
+
+    def progress(self, sensor, fraction):
+        """ Publish progress in 10% steps """
+        step = int(fraction * 10)
+        if step != self.step:
+            self.step = step
+            self.publish("running", sensor=sensor.label, progress=step * 10)
+
+    def run(self,):
+        """ Calibrate each sensor in turn while sampling continues """
+        self.publish("started", sensors=[sensor.label for sensor in self.sensors])
+        for sensor in self.sensors:
+            self.step = -1
+            try:
+                completed = sensor.run_calibration(
+                    self.cancel, lambda fraction, sensor=sensor: self.progress(sensor, fraction))
+            except Exception as err: # pylint: disable=broad-except
+                self.logger.error(sensor.label+" calibration failed: "+repr(err))
+                self.publish("failed", sensor=sensor.label, reason=repr(err))
+                return
+            if self.cancel.is_set():
+                self.publish("cancelled", sensor=sensor.label)
+                return
+            if not completed:
+                self.publish("failed", sensor=sensor.label, reason="calibration not completed")
+                return
+        self.publish("completed")
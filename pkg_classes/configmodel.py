@@ -25,32 +25,134 @@
 
 import argparse
 import logging
-import logging.config
+import math
+
+from pkg_classes.deadband import parse_deadbands
+from pkg_classes.gatewaymodel import load_instances
+from pkg_classes.sensorhal import SENSOR_REGISTRY
 
 class ConfigModel:
     """ Command line arguement model which expects an MQTT broker hostname or IP address,
         the location topic for the device and an option mode for the switch.
     """
 
-    def __init__(self, logging_file):
-        """ Parse the command line arguements """
-        logging.config.fileConfig(fname=logging_file, disable_existing_loggers=False)
-        # Get the logger specified in the file
+    def __init__(self, argv=None):
+        """ Parse the command line arguements, or argv when it is given """
         self.logger = logging.getLogger(__name__)
         parser = argparse.ArgumentParser('Command Line Parser')
         parser.add_argument('--mqtt', help='MQTT server IP address')
+        parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT broker port')
+        parser.add_argument('--mqtt-protocol', choices=['3.1.1', '5'], default='3.1.1',
+                            help='MQTT protocol, 5 answers queries on their response topic')
+        parser.add_argument('--mqtt-qos', type=int, choices=[0, 1, 2], default=1,
+                            help='Lowest QoS for publishes')
+        parser.add_argument('--mqtt-inflight', type=int, default=20,
+                            help='Unacknowledged QoS 1 and 2 messages before queueing')
+        parser.add_argument('--mqtt-queue', type=int, default=500,
+                            help='Queued messages before publishes are spooled instead')
         parser.add_argument('--location', help='Location topic required')
+        parser.add_argument('--gateway',
+                            help='JSON file of locations this process serves, replaces --location')
         parser.add_argument('--webserver', help='Web server IP required')
-        args = parser.parse_args()
+        parser.add_argument('--django-cache', default='/usr/local/sensor/django_ids.json',
+                            help='File the Django ids are cached in, empty to look them up')
+        parser.add_argument('--django-cache-ttl', type=float, default=24.0,
+                            help='Hours before cached Django ids are looked up again')
+        parser.add_argument('--sensors', default='bme680,veml7700',
+                            help='Comma separated sensors on this node')
+        parser.add_argument('--calibration', choices=['burnin', 'incremental'],
+                            default='incremental', help='BME680 gas baseline calibration')
+        parser.add_argument('--gas-window', type=int, default=50,
+                            help='Gas readings in the incremental baseline window')
+        parser.add_argument('--gas-decay', type=float, default=0.05,
+                            help='Incremental baseline decay factor between 0 and 1')
+        parser.add_argument('--calibration-state', default='/usr/local/sensor/calibration.json',
+                            help='File the BME680 baselines are kept in across restarts')
+        parser.add_argument('--calibration-max-age', type=float, default=24.0,
+                            help='Hours a saved baseline stays usable after a restart')
+        parser.add_argument('--publish', choices=['fields', 'batch', 'both'],
+                            default='fields', help='Per-field topics, one snapshot or both')
+        parser.add_argument('--encoding', choices=['json', 'cbor'], default='json',
+                            help='Snapshot payload encoding')
+        parser.add_argument('--spool', default='/usr/local/sensor/spool.db',
+                            help='Store-and-forward spool database')
+        parser.add_argument('--spool-size', type=float, default=8.0,
+                            help='Spool size limit in megabytes')
+        parser.add_argument('--sample-rate', type=float, default=0.1,
+                            help='Samples per second, 0.01 to 10')
+        parser.add_argument('--decimate', type=int, default=0,
+                            help='Raw readings per decimated sample, 0 for one every 10 seconds')
+        parser.add_argument('--outlier-window', type=int, default=7,
+                            help='Readings in the Hampel outlier filter, 0 checks ranges only')
+        parser.add_argument('--outlier-threshold', type=float, default=3.0,
+                            help='Deviations from the median before a reading is an outlier')
+        parser.add_argument('--bme680-oversample',
+                            help='BME680 temperature,humidity,pressure oversampling, e.g. 8,2,4')
+        parser.add_argument('--bme680-filter', type=int, choices=[0, 1, 3, 7, 15, 31, 63, 127],
+                            help='BME680 IIR filter size')
+        parser.add_argument('--veml7700-gain', choices=['1/8', '1/4', '1', '2'],
+                            help='VEML7700 ambient light gain')
+        parser.add_argument('--veml7700-integration', type=int,
+                            choices=[25, 50, 100, 200, 400, 800],
+                            help='VEML7700 integration time in milliseconds')
+        parser.add_argument('--publish-minutes', default='1,11,21,31,41,51',
+                            help='Minutes past each hour to average and publish')
+        parser.add_argument('--publish-period', type=float, default=0.0,
+                            help='Publish every period seconds instead of at minutes')
+        parser.add_argument('--jitter-budget', type=float, default=0.0,
+                            help='Spread publishing over this many seconds per node')
+        parser.add_argument('--calibrate-minute', type=int, default=55,
+                            help='Minute past each hour to calibrate')
+        parser.add_argument('--report-by-exception', action='store_true',
+                            help='Publish fields only when they change beyond the deadband')
+        parser.add_argument('--deadband',
+                            default='temperature=0.5,humidity=1,pressure=0.1,gas=5%,'
+                                    'airQuality=2,ambientLight=10|10%,lux=2|10%',
+                            help='Per-field display unit deadbands, absolute|percent%%')
+        parser.add_argument('--heartbeat', type=float, default=3600.0,
+                            help='Seconds before an unchanged field is published again')
+        parser.add_argument('--history',
+                            help='SQLite file for local sample history, off when not given')
+        parser.add_argument('--history-retention', default='1,7,30,365',
+                            help='Days to keep raw samples, 1 minute, 10 minute and hourly rollups')
+        parser.add_argument('--log-json', action='store_true',
+                            help='Write log records as JSON lines')
+        parser.add_argument('--metrics',
+                            help='Serve Prometheus metrics on a port, host:port or socket path')
+        args = parser.parse_args(argv)
         # command line arguement for the MQTT broker hostname or IP
         if args.mqtt is None:
             self.logger.error("Terminating> --mqtt not provided")
             exit() # manadatory
         self.broker_ip = args.mqtt
-        # command line arguement for the location topic
-        if args.location is None:
+        if args.mqtt_inflight < 1 or args.mqtt_queue < 1:
+            self.logger.error("Terminating> --mqtt-inflight and --mqtt-queue must be positive")
+            exit()
+        self.connection = (args.mqtt_port, args.mqtt_protocol, args.mqtt_qos,
+                           args.mqtt_inflight, args.mqtt_queue)
+        # every sensor must be known to the registry
+        self.sensors = args.sensors.split(",")
+        for name in self.sensors:
+            if name not in SENSOR_REGISTRY:
+                self.logger.error("Terminating> unknown sensor "+name)
+                exit()
+        # command line arguement for the location topic, or the gateway file
+        # with a location per instance
+        self.gateway = args.gateway is not None
+        if self.gateway:
+            try:
+                self.instances = load_instances(args.gateway, self.sensors)
+            except (OSError, ValueError) as err:
+                self.logger.error("Terminating> --gateway "+str(err))
+                exit()
+            args.location = self.instances[0]['location']
+        elif args.location is None:
             self.logger.error("Terminating> --location not provided")
             exit() # mandatory
+        else:
+            self.instances = [{'location': args.location, 'sensors': self.sensors,
+                               'bus': None, 'mux': None, 'channel': None,
+                               'simulated': False, 'seed': 0}]
         self.location = args.location
         # command line arguement for the webserver topic
         if args.webserver is None:
@@ -59,19 +161,182 @@ class ConfigModel:
         self.webserver = args.webserver
         server = self.webserver.split(".", 1)
         self.server_name = server[0]
+        if args.django_cache_ttl <= 0.0:
+            self.logger.error("Terminating> --django-cache-ttl must be positive")
+            exit()
+        self.django_cache = (args.django_cache or None, args.django_cache_ttl * 3600.0)
+        # incremental calibration needs a usable window and decay factor
+        if args.gas_window < 1 or not 0.0 < args.gas_decay <= 1.0:
+            self.logger.error("Terminating> --gas-window or --gas-decay out of range")
+            exit()
+        self.calibration = (args.calibration, args.gas_window, args.gas_decay)
+        # an empty path always calibrates from scratch
+        if args.calibration_max_age <= 0.0:
+            self.logger.error("Terminating> --calibration-max-age must be positive")
+            exit()
+        self.calibration_state = (args.calibration_state or None,
+                                  args.calibration_max_age * 3600.0)
+        self.publish = (args.publish, args.encoding)
+        self.spool = (args.spool, int(args.spool_size * 1024 * 1024))
+        # sample rate and the boxcar decimation into the averaging window
+        if not 0.01 <= args.sample_rate <= 10.0 or args.decimate < 0:
+            self.logger.error("Terminating> --sample-rate or --decimate out of range")
+            exit()
+        factor = args.decimate or max(1, round(args.sample_rate * 10.0))
+        self.sampling = (args.sample_rate, factor)
+        if args.outlier_window < 0 or args.outlier_threshold <= 0.0:
+            self.logger.error("Terminating> --outlier-window or --outlier-threshold out of range")
+            exit()
+        self.outlier_filter = (args.outlier_window, args.outlier_threshold)
+        # publish and calibration schedule
+        try:
+            minutes = tuple(int(minute) for minute in args.publish_minutes.split(","))
+        except ValueError:
+            self.logger.error("Terminating> --publish-minutes needs comma separated minutes")
+            exit()
+        if any(not 0 <= minute < 60 for minute in minutes + (args.calibrate_minute,)) or \
+                args.publish_period < 0.0 or args.jitter_budget < 0.0:
+            self.logger.error("Terminating> publish or calibrate schedule out of range")
+            exit()
+        self.schedule = (minutes, args.publish_period, args.calibrate_minute)
+        self.jitter_budget = args.jitter_budget
+        # the averaging window holds every stored sample between publishes,
+        # with room for the partial sample flushed at publish time
+        interval = args.publish_period
+        if not interval:
+            ordered = sorted(set(minutes))
+            gaps = [(after - before) % 60 or 60
+                    for before, after in zip(ordered, ordered[1:] + ordered[:1])]
+            interval = 60.0 * max(gaps)
+        self.window_capacity = math.ceil(args.sample_rate / factor * interval) + 2
+        # driver settings, None leaves the driver default
+        oversample = None
+        if args.bme680_oversample is not None:
+            try:
+                oversample = tuple(int(value) for value in args.bme680_oversample.split(","))
+            except ValueError:
+                oversample = ()
+            if len(oversample) != 3 or \
+                    any(value not in (0, 1, 2, 4, 8, 16) for value in oversample):
+                self.logger.error("Terminating> --bme680-oversample needs three of 0,1,2,4,8,16")
+                exit()
+        self.bme680_settings = (oversample, args.bme680_filter)
+        self.veml7700_settings = (args.veml7700_gain, args.veml7700_integration)
+        # report by exception applies to the per-field topics
+        try:
+            deadbands = parse_deadbands(args.deadband)
+        except ValueError:
+            self.logger.error("Terminating> --deadband needs field=amount or field=percent")
+            exit()
+        if args.heartbeat <= 0.0:
+            self.logger.error("Terminating> --heartbeat must be positive")
+            exit()
+        enabled = args.report_by_exception and args.publish != 'batch'
+        self.deadband = (enabled, deadbands, args.heartbeat)
+        # local history, each tier is kept longer than the one before
+        try:
+            retention = tuple(float(days) * 86400.0 for days in args.history_retention.split(","))
+        except ValueError:
+            retention = ()
+        if len(retention) != 4 or any(days <= 0.0 for days in retention):
+            self.logger.error("Terminating> --history-retention needs four positive day counts")
+            exit()
+        self.history = (args.history, retention)
+        self.metrics = args.metrics
+        self.log_json = args.log_json
 
     def get_broker(self, ):
         """ MQTT BORKER hostname or IP address."""
         return self.broker_ip
 
+    def get_connection(self,):
+        """ MQTT port, protocol, lowest QoS, in-flight and queue limits """
+        return self.connection
+
     def get_location(self, ):
-        """ MQTT location topic for the device. """
+        """ MQTT location topic for the device, the first one on a gateway. """
         return self.location
 
+    def get_gateway(self,):
+        """ True when a gateway file lists the locations """
+        return self.gateway
+
+    def get_instances(self,):
+        """ Location, sensors, I2C bus, multiplexer and simulation per instance """
+        return self.instances
+
     def get_server_name(self,):
         """ Web server hostname or IP address """
         return self.server_name
 
     def get_django_api_url(self,):
         """ Web server hostname or IP address """
-        return 'http://' + self.webserver + "/api"
\ No newline at end of file
+        return 'http://' + self.webserver + "/api"
+
+    def get_django_cache(self,):
+        """ Django id cache path, None when disabled, and time to live in seconds """
+        return self.django_cache
+
+    def get_calibration(self,):
+        """ BME680 calibration mode, gas window size and decay factor """
+        return self.calibration
+
+    def get_calibration_state(self,):
+        """ Saved baseline path, None when disabled, and maximum age in seconds """
+        return self.calibration_state
+
+    def get_publish(self,):
+        """ Publish mode and snapshot encoding """
+        return self.publish
+
+    def get_spool(self,):
+        """ Spool database path and size limit in bytes """
+        return self.spool
+
+    def get_sensors(self,):
+        """ Names of the sensors on this node """
+        return self.sensors
+
+    def get_sampling(self,):
+        """ Sample rate in Hz and raw readings per decimated sample """
+        return self.sampling
+
+    def get_window_capacity(self,):
+        """ Stored samples in the longest interval between publishes """
+        return self.window_capacity
+
+    def get_outlier_filter(self,):
+        """ Hampel window in readings, 0 when off, and threshold """
+        return self.outlier_filter
+
+    def get_bme680_settings(self,):
+        """ BME680 (temperature, humidity, pressure) oversampling and filter size """
+        return self.bme680_settings
+
+    def get_veml7700_settings(self,):
+        """ VEML7700 gain and integration time in milliseconds """
+        return self.veml7700_settings
+
+    def get_schedule(self,):
+        """ Publish minutes, publish period and calibration minute """
+        return self.schedule
+
+    def get_jitter_budget(self,):
+        """ Seconds over which nodes spread their publish times """
+        return self.jitter_budget
+
+    def get_deadband(self,):
+        """ Report by exception enabled, per-field deadbands and heartbeat seconds """
+        return self.deadband
+
+    def get_history(self,):
+        """ History database path, None when disabled, and retention in seconds """
+        return self.history
+
+    def get_metrics(self,):
+        """ Metrics address, None when metrics are not served """
+        return self.metrics
+
+    def get_log_json(self,):
+        """ True to write log records as JSON lines """
+        return self.log_json
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+""" MQTT connection with reconnect backoff, last will and flow control """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import logging
+
+import paho.mqtt.client as mqtt
+
+from pkg_classes.metricsmodel import METRICS
+
+# reconnect delays in seconds, doubled by paho after each failure
+RECONNECT_MIN = 1
+RECONNECT_MAX = 120
+
+class ConnectionModel:
+    """ Owns the paho client. Connecting and reconnecting happen on the paho
+        network thread with exponential backoff, a retained last will marks
+        the node offline on the status topic, and publishers see a full
+        queue as a failed publish so they can spool instead of piling up.
+        Works with the callback API of paho 1.x and 2.x.
+    """
+
+    def __init__(self, broker, status_topic, port=1883, protocol='3.1.1', qos=1,
+                 max_inflight=20, max_queued=500, client=None):
+        """ Create the client, nothing is sent until start. client stands in
+            for the paho client, for example a simulated broker.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.broker = broker
+        self.port = port
+        self.status_topic = status_topic
+        self.qos = qos
+        self.connected = threading.Event()
+        self.connect_callbacks = []
+        version = mqtt.MQTTv5 if protocol == '5' else mqtt.MQTTv311
+        self.version2 = hasattr(mqtt, 'CallbackAPIVersion')
+        if client is not None:
+            self.client = client
+        elif self.version2:
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=version)
+        else:
+            self.client = mqtt.Client(protocol=version)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
+        self.client.reconnect_delay_set(RECONNECT_MIN, RECONNECT_MAX)
+        self.client.will_set(status_topic, "offline", 1, True)
+
+    def add_connect_callback(self, method):
+        """ method(client) runs after every successful connect, for example to
+            subscribe again
+        """
+        self.connect_callbacks.append(method)
+
+    def set_message_callback(self, method):
+        """ method(client, userdata, msg) receives subscribed messages """
+        self.client.on_message = method
+
+    def start(self,):
+        """ Connect in the background, failures are retried with backoff """
+        self.client.connect_async(self.broker, self.port, 60)
+        self.client.loop_start()
+
+    def wait_connected(self, timeout=None):
+        """ True once connected, False if timeout passed first """
+        return self.connected.wait(timeout)
+
+    def stop(self,):
+        """ Mark the node offline and disconnect cleanly """
+        try:
+            if self.connected.is_set():
+                self.client.publish(self.status_topic, "offline", 1, True).wait_for_publish(5.0)
+        finally:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, reason, properties=None):
+        """ Publish online, run the connect callbacks and wake the waiters """
+        # pylint: disable=unused-argument
+        if reason != 0:
+            self.logger.error("MQTT connect refused: "+str(reason))
+            return
+        self.logger.info("MQTT connected to "+self.broker)
+        client.publish(self.status_topic, "online", 1, True)
+        for method in self.connect_callbacks:
+            method(client)
+        self.connected.set()
+
+    def on_disconnect(self, client, userdata, *args):
+        """ paho reconnects on its own, publishers spool until it does """
+        # pylint: disable=unused-argument
+        reason = args[1] if self.version2 else args[0]
+        self.connected.clear()
+        self.logger.warning("MQTT disconnected: "+str(reason))
+
+    def on_publish(self, client, userdata, mid, *args):
+        """ Count publishes the broker acknowledged """
+        # pylint: disable=unused-argument
+        METRICS.inc('diyha_mqtt_acks_total')
+
+    def is_connected(self,):
+        """ Connected and subscribed """
+        return self.connected.is_set()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """ Same as the client publish with QoS raised to the configured
+            minimum. A full queue returns MQTT_ERR_QUEUE_SIZE right away.
+        """
+        return self.client.publish(topic, payload, max(qos, self.qos), retain,
+                                   properties=properties)
+
+    def subscribe(self, topic, qos=0):
+        """ Subscribe now if connected, connect callbacks renew it later """
+        if not self.connected.is_set():
+            return (mqtt.MQTT_ERR_NO_CONN, None)
+        return self.client.subscribe(topic, qos)
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+""" Report by exception with per-field deadbands and a heartbeat """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# an out of cycle publish needs a change this many deadbands from the last value
+EXCEPTION_FACTOR = 2.0
+
+class DeadbandFilter:
+    """ Decide whether a value differs enough from the last published one.
+        A deadband is the larger of an absolute amount and a fraction of the
+        last value. Fields without a deadband only suppress identical values.
+    """
+
+    def __init__(self, deadbands, heartbeat):
+        """ deadbands maps field to (absolute, fraction) """
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat
+        self.last = {}
+
+    def threshold(self, key):
+        """ Deadband around the last published value of key """
+        absolute, fraction = self.deadbands.get(key, (0.0, 0.0))
+        return max(absolute, fraction * abs(self.last[key][0]))
+
+    def changed(self, key, value):
+        """ True when value is outside the deadband of the last published value """
+        if key not in self.last:
+            return True
+        amount = self.threshold(key)
+        if amount == 0.0:
+            return value != self.last[key][0]
+        return abs(value - self.last[key][0]) >= amount
+
+    def significant(self, key, value):
+        """ True when a configured field moved far enough to publish at once """
+        if key not in self.deadbands or key not in self.last:
+            return False
+        return abs(value - self.last[key][0]) >= EXCEPTION_FACTOR * self.threshold(key)
+
+    def should_publish(self, key, value, now):
+        """ Publish a changed value, or any value after heartbeat seconds """
+        return self.changed(key, value) or now - self.last[key][1] >= self.heartbeat
+
+    def published(self, key, value, now):
+        """ Remember what was published and when """
+        self.last[key] = (value, now)
+
+def parse_deadbands(spec):
+    """ 'temperature=0.5,lux=2|10%' to {'temperature': (0.5, 0.0), 'lux': (2.0, 0.1)} """
+    deadbands = {}
+    for entry in filter(None, spec.split(",")):
+        key, amounts = entry.split("=")
+        absolute, fraction = 0.0, 0.0
+        for amount in amounts.split("|"):
+            if amount.endswith("%"):
+                fraction = float(amount[:-1]) / 100.0
+            else:
+                absolute = float(amount)
+        deadbands[key.strip()] = (absolute, fraction)
+    return deadbands
@@ -24,25 +24,40 @@
 # THE SOFTWARE.
 
 import logging
-import logging.config
 import socket
 import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+
+from pkg_classes.atomicfile import write_json
+from pkg_classes.metricsmodel import METRICS
 
 # GLOBALS
 
 HEADERS = {'Content-type': 'application/json'} # put parameters are json
+TIMEOUT = (3.05, 10.0) # connect and read timeouts in seconds
+RETRIES = 4 # attempts per PUT before it is dropped
+BACKOFF = 2.0 # first retry delay in seconds, doubled on each retry
+QUEUE_SIZE = 16 # pending PUTs, the oldest is dropped when full
+LOOKUP_RETRY = 30.0 # first delay before looking up missing ids again, doubled
+LOOKUP_RETRY_MAX = 900.0 # longest delay between id lookups
 
 # General methods
 
-def put(url, info, logger):
-    """ REST put json server info to the Django server """
+def put(session, url, info, logger):
+    """ REST put json server info to the Django server, True if successful """
+    status = "error"
     try:
-        print(url)
-        print(info)
-        response = requests.put(url, data=json.dumps(info), headers=HEADERS)
+        with METRICS.timer('django_put'):
+            response = session.put(url, data=json.dumps(info), timeout=TIMEOUT)
+        status = response.status_code
         response.raise_for_status()
         # Code here will only run if the request is successful
+        return True
     except requests.exceptions.HTTPError as errh:
         logger.debug(errh)
     except requests.exceptions.ConnectionError as errc:
@@ -51,43 +66,218 @@ def put(url, info, logger):
         logger.debug(errt)
     except requests.exceptions.RequestException as err:
         logger.debug(err)
+    finally:
+        METRICS.inc('diyha_django_put_total', {'status': status})
+    return False
+
+def find_id(listing, location, host_match=True):
+    """ The id of the entry named after this host, unless host_match is
+        False, or after the location. Zero when there is none.
+    """
+    names = (socket.gethostname(), location) if host_match else (location,)
+    try:
+        for info in listing or []:
+            if info["name"] in names:
+                return int(info["id"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return 0
 
 # Django Model Class
 
 class DjangoModel:
     """ The DjangoModel class is used to encapsulate several RESTful API calls to a
         Django web server. This class is used in my do it yourself home automation system.
+        PUTs are queued and sent by a background worker over a keep-alive session.
     """
 
-    def __init__(self, logging_file):
+    def __init__(self):
         """ Prepare for logging, urls and serve ids for REST put """
-        logging.config.fileConfig(fname=logging_file, disable_existing_loggers=False)
-        # Get the logger specified in the file
         self.logger = logging.getLogger(__name__)
         self.urls = {"status": "/server/status", "assets": "/server/assets", \
             "environment": "/environment", "motion": "/motion"}
         self.ids = {"status": 0, "assets": 0, "environment": 0, "motion": 0}
+        # environment ids of the other locations served by a gateway
+        self.environment_ids = {}
+        self.location = ''
+        # ids are looked up in the background and kept in a cache file, PUTs
+        # for an id that is still unknown are held until it is found
+        self.cache_path = None
+        self.cache_ttl = 0.0
+        self.cache_key = ''
+        self.stale = True
+        self.held = {}
+        self.resolving = threading.Condition()
+        self.resolver = None
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        # one connection per listing so the lookups run side by side
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(self.ids))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # store-and-forward spool, delivery state and time of last success per url
+        self.spool = None
+        self.online = False
+        self.delivered = {}
+        self.clock = time
+        # pending PUTs keyed by url so a newer update replaces a stale one
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.sending = False
+        self.worker = threading.Thread(target=self.run_worker, name="django", daemon=True)
+        self.worker.start()
+
+    def set_session(self, session):
+        """ Replace the HTTP session, for example with a simulated server """
+        self.session = session
+
+    def set_clock(self, clock):
+        """ Replace the time module for delivery times, which are compared
+            with the spool timestamps
+        """
+        self.clock = clock
+
+    def set_spool(self, spool):
+        """ Spool PUTs that run out of retries for replay after reconnect """
+        self.spool = spool
+        spool.set_django(self)
+
+    def set_cache(self, path, ttl):
+        """ Keep the looked up ids in path, they are looked up again once
+            they are ttl seconds old. A path of None disables the cache.
+        """
+        self.cache_path = path
+        self.cache_ttl = ttl
 
     def set_urls(self, webserver, location):
-        """ Create API strings based on hostname or IP address."""
+        """ Create API strings based on hostname or IP address, then look up
+            the ids in the background so a slow server never delays startup
+        """
         for key in self.ids:
             self.urls[key] = webserver + self.urls[key]
-            self.get_id(key, location)
+        self.location = location
+        self.load_cache(webserver)
+        self.resolver = threading.Thread(target=self.run_resolver, name="django ids",
+                                         daemon=True)
+        self.resolver.start()
+
+    def add_location(self, location):
+        """ Look up the environment id of another location, put_environment
+            picks it by the name in the info
+        """
+        with self.resolving:
+            self.environment_ids.setdefault(location, 0)
+            self.resolving.notify_all()
 
-    def get_id(self, key, location):
-        """ Find the server id from the Django database (PIR sensors)."""
+    def load_cache(self, webserver):
+        """ Use the cached ids of this host and server, even stale ones, until
+            a lookup replaces them
+        """
+        self.cache_key = webserver+" "+socket.gethostname()+" "+self.location
+        if self.cache_path is None:
+            return
         try:
-            response = requests.get(self.urls[key])
-            info_array = response.json()
-            host = socket.gethostname()
-            for info in info_array:
-                if host == info["name"]:
-                    self.ids[key] = info["id"]
-                    break
-                elif location == info["name"]:
-                    self.ids[key] = info["id"]
-                    break
-            # Code here will only run if the request is successful
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+            if cache['key'] != self.cache_key:
+                self.logger.info("Django id cache is for another server, ignored")
+                return
+            ids = {key: int(cache['ids'].get(key, 0)) for key in self.ids}
+            locations = {name: int(value) for name, value in cache['locations'].items()}
+            age = time.time() - float(cache['timestamp'])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            self.logger.warning("Django id cache unreadable: "+repr(err))
+            return
+        with self.resolving:
+            self.ids.update(ids)
+            self.environment_ids.update(locations)
+            self.stale = not 0.0 <= age <= self.cache_ttl
+        self.logger.info("Django ids loaded from cache, {0:.1f} hours old".format(age / 3600.0))
+
+    def save_cache(self,):
+        """ Write the ids to the cache file """
+        if self.cache_path is None:
+            return
+        with self.resolving:
+            cache = {'key': self.cache_key, 'timestamp': time.time(), 'ids': dict(self.ids),
+                     'locations': dict(self.environment_ids)}
+        try:
+            write_json(self.cache_path, cache)
+        except OSError as err:
+            self.logger.error("Django id cache not saved: "+repr(err))
+
+    def lookups(self,):
+        """ (key, name, host_match) of every id still to be looked up """
+        wanted = [(key, self.location, True) for key, server_id in self.ids.items()
+                  if self.stale or server_id == 0]
+        wanted += [("environment", name, False) for name, server_id
+                   in self.environment_ids.items() if self.stale or server_id == 0]
+        return wanted
+
+    def run_resolver(self,):
+        """ Look up missing ids, retrying with backoff while any is missing,
+            and refresh them all once the cache time to live has passed. A
+            refresh that fails keeps the ids already known and stays stale,
+            so the cache keeps its old timestamp and is retried with backoff.
+        """
+        delay = LOOKUP_RETRY
+        while True:
+            with self.resolving:
+                wanted = self.lookups()
+                if not wanted:
+                    # wait for a new location or for the ids to expire
+                    if not self.resolving.wait_for(self.lookups, self.cache_ttl or None):
+                        self.stale = True
+                    continue
+            found, fetched = self.resolve(wanted)
+            with self.resolving:
+                for (key, name, host_match), server_id in zip(wanted, found):
+                    if server_id == 0:
+                        continue
+                    if host_match:
+                        self.ids[key] = server_id
+                    else:
+                        self.environment_ids[name] = server_id
+                if fetched:
+                    self.stale = False
+                missing = self.lookups()
+                self.resolving.notify_all()
+            self.release_held()
+            if not missing:
+                self.logger.info("Django ids resolved: "+str(self.ids))
+                self.save_cache()
+                delay = LOOKUP_RETRY
+                continue
+            if any(lookup not in wanted for lookup in missing):
+                # a location added during this pass is looked up at once
+                continue
+            self.logger.warning("{0} Django ids still to look up, retrying in {1:.0f} "
+                                "seconds".format(len(missing), delay))
+            with self.resolving:
+                # a new location is looked up without waiting for the retry
+                self.resolving.wait_for(lambda: len(self.lookups()) > len(missing), delay)
+            delay = min(delay * 2.0, LOOKUP_RETRY_MAX)
+
+    def resolve(self, wanted):
+        """ Fetch each listing once, concurrently, and find the wanted ids.
+            Also True when every listing was fetched.
+        """
+        keys = sorted({key for key, _, _ in wanted})
+        if not keys:
+            return [], True
+        with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+            listings = dict(zip(keys, executor.map(self.get_listing, keys)))
+        found = [find_id(listings[key], name, host_match) for key, name, host_match in wanted]
+        return found, all(listing is not None for listing in listings.values())
+
+    def get_listing(self, key):
+        """ One Django listing, None when the server can not be reached """
+        try:
+            response = self.session.get(self.urls[key], timeout=TIMEOUT)
+            response.raise_for_status()
+            return response.json()
         except requests.exceptions.HTTPError as errh:
             self.logger.debug(errh)
         except requests.exceptions.ConnectionError as errc:
@@ -96,28 +286,97 @@ class DjangoModel:
             self.logger.debug(errt)
         except requests.exceptions.RequestException as err:
             self.logger.debug(err)
+        except ValueError as err:
+            self.logger.debug(err)
+        return None
+
+    def wait_ids(self, timeout=None):
+        """ Wait until no id lookup is outstanding, True when all were found """
+        with self.resolving:
+            return self.resolving.wait_for(lambda: not self.lookups(), timeout)
+
+    def put_id(self, key, server_id, info):
+        """ Queue a PUT to a known id, or hold the latest info for each
+            unknown id since there is no record 0 to update
+        """
+        if server_id == 0:
+            with self.resolving:
+                self.held[(key, info.get("name"))] = info
+            self.logger.debug("Holding "+key+" PUT until its id is known")
+            return
+        info["id"] = server_id
+        self.enqueue(self.urls[key] + "/" + str(server_id), info)
+
+    def release_held(self,):
+        """ Send the held PUTs whose ids have been found """
+        with self.resolving:
+            held, self.held = self.held, {}
+        puts = {"status": self.put_server_status, "assets": self.put_server_asset,
+                "environment": self.put_environment, "motion": self.put_motion}
+        for (key, _), info in held.items():
+            puts[key](info)
 
     def put_server_status(self, info):
         """ REST put json cpu status to the Django server """
-        info["id"] = self.ids["status"]
-        url = self.urls["status"] + "/" + str(self.ids["status"])
-        put(url, info, self.logger)
+        self.put_id("status", self.ids["status"], info)
 
     def put_server_asset(self, info):
         """ REST put json server asset info to the Django server """
-        info["id"] = self.ids["assets"]
-        url = self.urls["assets"]  + "/" + str(self.ids["assets"])
-        put(url, info, self.logger)
+        self.put_id("assets", self.ids["assets"], info)
 
     def put_environment(self, info):
         """ REST put json server asset info to the Django server """
-        info["id"] = self.ids["environment"]
-        url = self.urls["environment"]  + "/" + str(self.ids["environment"])
-        put(url, info, self.logger)
+        self.put_id("environment",
+                    self.environment_ids.get(info.get("name"), self.ids["environment"]), info)
 
     def put_motion(self, info):
         """ REST put json server asset info to the Django server """
-        info["id"] = self.ids["motion"]
-        url = self.urls["motion"]  + "/" + str(self.ids["motion"])
-        put(url, info, self.logger)
+        self.put_id("motion", self.ids["motion"], info)
+
+    def enqueue(self, url, info):
+        """ Queue a PUT for the worker without waiting on HTTP """
+        with self.condition:
+            if url in self.pending:
+                self.logger.debug("Coalesced stale PUT "+url)
+            elif len(self.pending) >= QUEUE_SIZE:
+                dropped, _ = self.pending.popitem(last=False)
+                self.logger.warning("PUT queue full, dropped "+dropped)
+            self.pending[url] = info
+            self.condition.notify_all()
+
+    def run_worker(self,):
+        """ Send queued PUTs in order, retrying with exponential backoff """
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                url, info = self.pending.popitem(last=False)
+                self.sending = True
+            delay = BACKOFF
+            for attempt in range(1, RETRIES + 1):
+                if put(self.session, url, info, self.logger):
+                    self.online = True
+                    self.delivered[url] = self.clock.time()
+                    break
+                self.online = False
+                if attempt == RETRIES:
+                    self.logger.warning("PUT failed after {0} attempts: {1}".format(
+                        RETRIES, url))
+                    if self.spool is not None:
+                        self.spool.put(url, info)
+                    break
+                with self.condition:
+                    # a newer update for this url supersedes the retry
+                    superseded = self.condition.wait_for(lambda: url in self.pending, delay)
+                if superseded:
+                    break
+                delay *= 2.0
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
 
+    def drain(self, timeout=None):
+        """ Wait until every queued PUT has been sent or given up on """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.pending and not self.sending, timeout)
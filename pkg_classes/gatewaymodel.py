@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+""" Gateway mode, one process driving sensors at many locations """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import threading
+import time
+import logging
+
+from pkg_classes.queryview import QueryView
+from pkg_classes.sensorhal import SENSOR_REGISTRY, create_sensor, size_of
+from pkg_classes.simulatedsensors import SIMULATED_DRIVERS
+from pkg_classes.snapshotview import SnapshotView
+from pkg_classes.timedevents import TimedEvents
+from pkg_classes.topicmodel import TopicModel
+
+def load_instances(path, sensors):
+    """ Read a gateway file, a JSON list with one object per location such as
+        {"location": "diy/upstairs/office", "sensors": "bme680,veml7700",
+        "bus": 1, "mux": 112, "channel": 3}. Only the location is required,
+        sensors defaults to --sensors and "simulated": true with a "seed"
+        uses simulated drivers. ValueError when the file is malformed.
+    """
+    with open(path) as gateway_file:
+        entries = json.load(gateway_file)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("a gateway file is a list of instances")
+    instances = []
+    names = set()
+    for entry in entries:
+        try:
+            instance = {'location': str(entry['location']),
+                        'sensors': entry.get('sensors', ",".join(sensors)).split(","),
+                        'bus': entry.get('bus'), 'mux': entry.get('mux'),
+                        'channel': entry.get('channel'),
+                        'simulated': bool(entry.get('simulated', False)),
+                        'seed': int(entry.get('seed', 0))}
+        except (AttributeError, KeyError, TypeError) as err:
+            raise ValueError("malformed instance "+repr(entry)) from err
+        name = instance['location'].rpartition("/")[2]
+        if not name or name in names:
+            raise ValueError("duplicate or empty location "+instance['location'])
+        names.add(name)
+        for sensor in instance['sensors']:
+            if sensor not in SENSOR_REGISTRY:
+                raise ValueError("unknown sensor "+sensor)
+        if instance['mux'] is not None and instance['channel'] not in range(8):
+            raise ValueError("a multiplexer needs a channel from 0 to 7")
+        instances.append(instance)
+    return instances
+
+class CpuMeter:
+    """ Context manager that adds the thread CPU time spent inside it to a
+        running total. Several threads may be inside at once, but one thread
+        must not enter it twice.
+    """
+
+    def __init__(self):
+        """ No CPU time used yet """
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __enter__(self):
+        """ Note the CPU time of this thread """
+        self.local.started = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Add the CPU time this thread used since it entered """
+        elapsed = time.thread_time() - self.local.started
+        with self.lock:
+            self.seconds += elapsed
+        return False
+
+class GatewayInstance:
+    """ The sensors, timer, snapshot and queries of one location. The MQTT
+        client, spool, Django model, history and scheduler are shared by
+        every instance in the process.
+    """
+
+    def __init__(self, config, instance, client, spool, django, history, gateway, clock=time):
+        """ Create and configure the sensors of one location, gateway labels
+            them with the location name. clock replaces the time module, for
+            example with a virtual clock.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.topic = TopicModel()
+        self.topic.set(instance['location'])
+        self.name = self.topic.get_location_name()
+        self.meter = CpuMeter()
+        self.sensors = []
+        for index, name in enumerate(instance['sensors']):
+            sensor = create_sensor(name, spool, self.topic.get_location_topic())
+            sensor.configure(config)
+            sensor.set_clock(clock)
+            sensor.set_bus(instance['bus'], instance['mux'], instance['channel'])
+            if gateway:
+                sensor.set_instance(self.name)
+            if history is not None:
+                sensor.set_history(history)
+            if instance['simulated']:
+                sensor.set_sensor(SIMULATED_DRIVERS[name](clock, instance['seed'] + index))
+            self.sensors.append(sensor)
+        self.timer = TimedEvents(client, self.name, django, self.sensors)
+        self.timer.set_meter(self.meter)
+        publish_mode, encoding = config.get_publish()
+        snapshot = SnapshotView(spool, self.topic.get_location_topic(), encoding)
+        snapshot.set_clock(clock)
+        self.timer.set_publish_mode(publish_mode, snapshot)
+        self.query = QueryView(client, self.topic.get_location_topic(), self.sensors, history)
+        self.query.set_clock(clock)
+
+    def set_engine(self, engine):
+        """ Hand timed events and read retries of this location to the engine """
+        self.timer.set_engine(engine)
+        for sensor in self.sensors:
+            sensor.set_engine(engine)
+
+    def start(self, engine, config):
+        """ Publish provisional values right after the first sample, then
+            the timed events at this location's own stable phase within the
+            jitter budget
+        """
+        self.set_engine(engine)
+        engine.add_task("provisional "+self.name, None, self.timer.execute_timed_event,
+                        delay=1.0)
+        offset = self.topic.get_phase_offset(config.get_jitter_budget())
+        self.logger.info("{0} publish phase offset {1:.1f} seconds".format(self.name, offset))
+        self.timer.schedule(engine.scheduler, *config.get_schedule(), offset)
+
+    def collect_samples(self,):
+        """ capture one sample from every sensor of this location """
+        with self.meter:
+            for sensor in self.sensors:
+                sensor.collect_sample()
+
+    def memory_bytes(self,):
+        """ Estimated bytes of the sampling state of this location's sensors
+            and its topic names, see SensorHAL.memory_bytes
+        """
+        total = sum(sensor.memory_bytes() for sensor in self.sensors)
+        return total + size_of(self.topic, self.name)
+
+    def report(self,):
+        """ Log the CPU time used so far and the estimated memory """
+        self.logger.info("{0}: {1:.2f} CPU seconds, {2} bytes".format(
+            self.name, self.meter.seconds, self.memory_bytes()))
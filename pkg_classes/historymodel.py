@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+""" Local time series history with downsampled rollups """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sqlite3
+import threading
+import time
+import logging
+
+# rollup bucket sizes in seconds, each one is built from the one before
+RESOLUTIONS = (60, 600, 3600)
+
+# seconds between deletions of rows past their retention
+PRUNE_INTERVAL = 3600.0
+
+class HistoryModel:
+    """ SQLite store of every decimated sample with 1 minute, 10 minute and
+        hourly min, max and mean rollups. Samples are buffered in memory and
+        written in batches, each tier is kept for its own retention period.
+    """
+
+    def __init__(self, path, retention=(86400.0, 604800.0, 2592000.0, 31536000.0)):
+        """ retention is seconds to keep raw samples then each rollup tier """
+        self.logger = logging.getLogger(__name__)
+        self.retention = dict(zip((0,) + RESOLUTIONS, retention))
+        self.clock = time
+        self.pending = []
+        self.pruned = 0.0
+        # record runs on the sampling loop, it never waits for a commit
+        self.pending_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS samples ("
+                                "sensor TEXT, field TEXT, timestamp REAL, value REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS samples_range "
+                                "ON samples (sensor, field, timestamp)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rollups ("
+                                "resolution INTEGER, sensor TEXT, field TEXT, start REAL, "
+                                "count INTEGER, minimum REAL, maximum REAL, total REAL, "
+                                "PRIMARY KEY (resolution, sensor, field, start))")
+        self.connection.commit()
+
+    def set_clock(self, clock):
+        """ Replace the time module, for example with a virtual clock """
+        self.clock = clock
+
+    def record(self, sensor, field, timestamp, value):
+        """ Buffer one sample until the next flush """
+        with self.pending_lock:
+            self.pending.append((sensor, field, timestamp, value))
+
+    def flush(self,):
+        """ Write buffered samples and merge them into every rollup tier """
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        buckets = {}
+        for sensor, field, timestamp, value in pending:
+            key = (RESOLUTIONS[0], sensor, field, timestamp - timestamp % RESOLUTIONS[0])
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, value, value, value]
+            else:
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], value)
+                bucket[2] = max(bucket[2], value)
+                bucket[3] += value
+        # coarser tiers merge the finer buckets rather than the samples
+        finer = list(buckets.items())
+        for resolution in RESOLUTIONS[1:]:
+            merged = {}
+            for (_, sensor, field, start), (count, low, high, total) in finer:
+                key = (resolution, sensor, field, start - start % resolution)
+                bucket = merged.get(key)
+                if bucket is None:
+                    merged[key] = [count, low, high, total]
+                else:
+                    bucket[0] += count
+                    bucket[1] = min(bucket[1], low)
+                    bucket[2] = max(bucket[2], high)
+                    bucket[3] += total
+            buckets.update(merged)
+            finer = list(merged.items())
+        with self.lock:
+            self.connection.executemany(
+                "INSERT INTO samples (sensor, field, timestamp, value) VALUES (?, ?, ?, ?)",
+                pending)
+            # a bucket written by an earlier flush is merged, not replaced
+            self.connection.executemany(
+                "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (resolution, sensor, field, start) DO UPDATE SET "
+                "count = count + excluded.count, "
+                "minimum = MIN(minimum, excluded.minimum), "
+                "maximum = MAX(maximum, excluded.maximum), "
+                "total = total + excluded.total",
+                [key + tuple(bucket) for key, bucket in buckets.items()])
+            now = self.clock.time()
+            if now - self.pruned >= PRUNE_INTERVAL:
+                self.prune(now)
+            self.connection.commit()
+
+    def prune(self, now):
+        """ Delete samples and rollups older than their tier's retention """
+        self.pruned = now
+        deleted = self.connection.execute("DELETE FROM samples WHERE timestamp < ?",
+                                          (now - self.retention[0],)).rowcount
+        for resolution in RESOLUTIONS:
+            deleted += self.connection.execute(
+                "DELETE FROM rollups WHERE resolution = ? AND start < ?",
+                (resolution, now - self.retention[resolution])).rowcount
+        if deleted:
+            self.logger.info("History pruned {0} rows".format(deleted))
+
+    def pick_resolution(self, start):
+        """ The finest tier that still holds data from start """
+        age = self.clock.time() - start
+        for resolution in (0,) + RESOLUTIONS:
+            if age <= self.retention[resolution]:
+                return resolution
+        return RESOLUTIONS[-1]
+
+    def query(self, sensor, field, start, end, resolution=None):
+        """ Rows of (start, count, min, max, mean) between start and end, raw
+            samples are resolution 0 and come back as single sample buckets
+        """
+        if resolution is None:
+            resolution = self.pick_resolution(start)
+        self.flush()
+        with self.lock:
+            if resolution == 0:
+                rows = self.connection.execute(
+                    "SELECT timestamp, 1, value, value, value FROM samples "
+                    "WHERE sensor = ? AND field = ? AND timestamp >= ? AND timestamp < ? "
+                    "ORDER BY timestamp", (sensor, field, start, end)).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT start, count, minimum, maximum, total / count FROM rollups "
+                    "WHERE resolution = ? AND sensor = ? AND field = ? "
+                    "AND start >= ? AND start < ? ORDER BY start",
+                    (resolution, sensor, field, start - start % resolution, end)).fetchall()
+        return rows
+
+    def summary(self, sensor, field, start, end, resolution=None):
+        """ Count, min, max and mean over a range, None when it holds no data """
+        rows = self.query(sensor, field, start, end, resolution)
+        if not rows:
+            return None
+        count = sum(row[1] for row in rows)
+        return {'samples': count,
+                'min': min(row[2] for row in rows),
+                'max': max(row[3] for row in rows),
+                'mean': sum(row[1] * row[4] for row in rows) / count}
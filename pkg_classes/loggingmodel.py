@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+""" One time logging setup with a background writer, JSON records and rate limits """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import atexit
+import json
+import queue
+import threading
+import time
+import logging
+import logging.config
+import logging.handlers
+
+# seconds a repeated warning or error is held back after it was logged
+REPEAT_INTERVAL = 60.0
+
+# distinct repeated messages tracked before the oldest are forgotten
+REPEAT_LIMIT = 1024
+
+# LogRecord attributes that are not extra fields
+RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message'}
+
+LISTENER = None
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line. Fields passed with extra, such as the stage
+        and seconds of a timed pipeline stage, are kept as their own keys.
+    """
+
+    def format(self, record):
+        """ Timestamp, level, logger, message and any extra fields """
+        entry = {'timestamp': record.created, 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class RepeatFilter(logging.Filter):
+    """ Logs a warning or error once per interval and counts the repeats it
+        held back, so a broker or server outage does not flood the log.
+    """
+
+    def __init__(self, interval=REPEAT_INTERVAL):
+        """ No messages seen yet """
+        super().__init__()
+        self.interval = interval
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        """ False for a repeat inside the interval """
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            last = self.seen.get(key)
+            if last is not None and now - last[0] < self.interval:
+                last[1] += 1
+                return False
+            if len(self.seen) >= REPEAT_LIMIT:
+                self.seen.clear()
+            self.seen[key] = [now, 0]
+        if last is not None and last[1]:
+            record.msg = str(record.msg) + " (repeated {0} times)".format(last[1])
+        return True
+
+def setup_logging(logging_file):
+    """ Read the INI file once, then move the root handlers behind a queue so
+        file and console I/O happen on a listener thread, not the caller's.
+        Later calls return the running listener.
+    """
+    global LISTENER # pylint: disable=global-statement
+    if LISTENER is not None:
+        return LISTENER
+    logging.config.fileConfig(fname=logging_file, disable_existing_loggers=False)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    # records below every handler's level are dropped before they are queued
+    queue_handler.setLevel(min((handler.level for handler in handlers), default=0))
+    queue_handler.addFilter(RepeatFilter())
+    root.addHandler(queue_handler)
+    LISTENER = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    LISTENER.start()
+    atexit.register(LISTENER.stop)
+    return LISTENER
+
+def use_json_format():
+    """ Switch every handler behind the queue to JSON records """
+    for handler in LISTENER.handlers:
+        handler.setFormatter(JsonFormatter())
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+""" Prometheus text format metrics for the sensor pipeline """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import bisect
+import http.server
+import os
+import socketserver
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+# histogram buckets in seconds, from an I2C read to a burn-in calibration
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 300.0)
+
+# every metric with its type and help text
+METRIC_HELP = {
+    'diyha_stage_seconds': ('histogram', 'Time spent in each pipeline stage'),
+    'diyha_i2c_errors_total': ('counter', 'Sensor reads that raised an error'),
+    'diyha_samples_rejected_total': ('counter',
+                                     'Readings rejected as out of range or outliers'),
+    'diyha_mqtt_publish_total': ('counter', 'MQTT publishes by result'),
+    'diyha_mqtt_acks_total': ('counter', 'MQTT publishes acknowledged by the broker'),
+    'diyha_django_put_total': ('counter', 'Django PUT attempts by HTTP status'),
+    'diyha_queue_depth': ('gauge', 'Items waiting in each queue'),
+    'diyha_spool_bytes': ('gauge', 'Bytes held in the store-and-forward spool'),
+    'diyha_sensor_value': ('gauge', 'Latest average of each field in sensor units'),
+    'diyha_instance_cpu_seconds_total': ('counter', 'CPU seconds used by each gateway instance'),
+    'diyha_instance_memory_bytes': ('gauge', 'Estimated memory of each gateway instance'),
+}
+
+class MetricsModel:
+    """ Counters, gauges and histograms kept in memory and rendered in the
+        Prometheus text format when scraped. Collectors are called at scrape
+        time for values that are cheaper to read than to track.
+    """
+
+    def __init__(self,):
+        """ Empty metrics """
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.collectors = []
+        self.server = None
+
+    def inc(self, name, labels=None, amount=1):
+        """ Add amount to a counter """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_gauge(self, name, value, labels=None):
+        """ Set a gauge to value """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, seconds, labels=None):
+        """ Add one observation to a histogram """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(BUCKETS, seconds)
+            if index < len(BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, stage, sensor=None):
+        """ Observe the time spent in the with block as a pipeline stage """
+        labels = {'stage': stage}
+        if sensor is not None:
+            labels['sensor'] = sensor
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe('diyha_stage_seconds', seconds, labels)
+            # timing fields become their own keys in JSON log records
+            self.logger.debug(stage+" took {0:.3f} seconds".format(seconds),
+                              extra=dict(labels, seconds=seconds))
+
+    def add_collector(self, collector):
+        """ collector() returns (name, labels, value) gauges at scrape time """
+        self.collectors.append(collector)
+
+    def render(self,):
+        """ Every metric in the Prometheus text exposition format """
+        lines = {}
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (list(buckets), total, count)
+                          for key, (buckets, total, count) in self.histograms.items()}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    values[(name, tuple(sorted(labels.items())))] = value
+            except Exception as err: # pylint: disable=broad-except
+                self.logger.error("Metrics collector failed: "+repr(err))
+        for (name, labels), value in sorted(values.items()):
+            lines.setdefault(name, []).append(name+format_labels(labels)+" "+repr(value))
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.setdefault(name, []).append(
+                    name+"_bucket"+format_labels(labels + (('le', repr(bound)),))+
+                    " "+str(cumulative))
+            lines[name].append(name+"_bucket"+format_labels(labels + (('le', '+Inf'),))+
+                               " "+str(count))
+            lines[name].append(name+"_sum"+format_labels(labels)+" "+repr(total))
+            lines[name].append(name+"_count"+format_labels(labels)+" "+str(count))
+        text = []
+        for name in sorted(lines):
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            text.append("# HELP "+name+" "+help_text)
+            text.append("# TYPE "+name+" "+kind)
+            text.extend(lines[name])
+        return "\n".join(text) + "\n"
+
+    def serve(self, address):
+        """ Serve /metrics on a port, host:port or a Unix socket path """
+        if address.startswith("/"):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = UnixHTTPServer(address, MetricsHandler)
+        else:
+            host, _, port = address.rpartition(":")
+            self.server = http.server.ThreadingHTTPServer((host or "0.0.0.0", int(port)),
+                                                          MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        self.logger.info("Metrics served on "+address)
+
+def format_labels(labels):
+    """ {a="1",b="2"} or nothing when there are no labels """
+    if not labels:
+        return ""
+    pairs = ['{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for key, value in labels]
+    return "{" + ",".join(pairs) + "}"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP over a local socket, for scraping through a forwarding agent """
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers every GET with the current metrics """
+
+    def do_GET(self,): # pylint: disable=invalid-name
+        """ Render the shared metrics """
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        """ Scrapes are too frequent to log """
+
+# the process wide metrics, cheap to update whether or not they are served
+METRICS = MetricsModel()
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+""" MQTT request and response queries for live values and local history """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import time
+import zlib
+import logging
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from pkg_classes.historymodel import RESOLUTIONS
+
+# seconds of history returned when a request gives no start
+DEFAULT_SPAN = 3600.0
+
+class QueryView:
+    """ Answers requests on <location>/query/live, /query/summary and
+        /query/history, every value in display units. MQTT v5 requests are
+        answered on their response topic with the correlation data echoed.
+        MQTT 3.1.1 requests may name a response_topic and correlation in the
+        JSON payload. Either response topic must be under
+        <location>/response/, otherwise the answer goes to
+        <location>/response/<command>.
+    """
+
+    def __init__(self, client, topic, sensors, history):
+        """ history is a HistoryModel, or None when history is disabled """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.topic = topic
+        self.sensors = {sensor.name: sensor for sensor in sensors}
+        self.history = history
+        self.clock = time
+
+    def set_clock(self, clock):
+        """ Replace the time module, for example with a virtual clock """
+        self.clock = clock
+
+    def get_handlers(self,):
+        """ Command topics and the methods that answer them """
+        return {self.topic+"/query/live": self.live,
+                self.topic+"/query/summary": self.summary,
+                self.topic+"/query/history": self.history_samples}
+
+    def response_topic(self, command, requested):
+        """ The requested response topic when it is under this location's
+            response prefix, otherwise the default topic of the command
+        """
+        prefix = self.topic+"/response/"
+        if requested is None:
+            return prefix+command
+        if not isinstance(requested, str) or not requested.startswith(prefix) or \
+                len(requested) == len(prefix) or '+' in requested or '#' in requested:
+            self.logger.warning(command+" response topic refused: "+repr(requested))
+            return prefix+command
+        return requested
+
+    def respond(self, msg, command, request, payload, content_type="application/json"):
+        """ Publish the answer where the requester asked for it """
+        properties = getattr(msg, 'properties', None)
+        requested = getattr(properties, 'ResponseTopic', None)
+        if requested is not None:
+            response_topic = self.response_topic(command, requested)
+            response = Properties(PacketTypes.PUBLISH)
+            correlation = getattr(properties, 'CorrelationData', None)
+            if correlation is not None:
+                response.CorrelationData = correlation
+            response.ContentType = content_type
+            self.client.publish(response_topic, payload, 1, False, properties=response)
+            return
+        response_topic = self.response_topic(command, request.get('response_topic'))
+        if 'correlation' in request:
+            # JSON answers carry the correlation, compressed ones are wrapped
+            payload = json.dumps({'correlation': request['correlation'],
+                                  'payload': json.loads(payload) \
+                                      if content_type == "application/json" \
+                                      else payload.hex()})
+        self.client.publish(response_topic, payload, 1, False)
+
+    def parse(self, msg):
+        """ The JSON request, empty when there is no payload """
+        if not msg.payload:
+            return {}
+        request = json.loads(msg.payload.decode('utf-8'))
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        return request
+
+    def handle(self, msg, command, answer):
+        """ Parse the request, answer it and report errors to the requester """
+        try:
+            request = self.parse(msg)
+        except ValueError as err:
+            self.logger.warning(command+" query rejected: "+repr(err))
+            self.respond(msg, command, {}, json.dumps({'error': str(err)}))
+            return
+        try:
+            payload, content_type = answer(request)
+        except (KeyError, TypeError, ValueError) as err:
+            self.logger.warning(command+" query failed: "+repr(err))
+            payload, content_type = json.dumps({'error': str(err)}), "application/json"
+        self.respond(msg, command, request, payload, content_type)
+
+    def time_range(self, request):
+        """ start and end epoch seconds, the last hour by default """
+        end = float(request.get('end', self.clock.time()))
+        start = float(request.get('start', end - DEFAULT_SPAN))
+        if start >= end:
+            raise ValueError("start must be before end")
+        return start, end
+
+    def series(self, request):
+        """ The sensor and field named by the request """
+        if self.history is None:
+            raise ValueError("history is disabled on this node")
+        sensor, field = request['sensor'], request['field']
+        if sensor not in self.sensors or field not in self.sensors[sensor].data:
+            raise ValueError("unknown series "+str(sensor)+"/"+str(field))
+        return sensor, field
+
+    def resolution(self, request):
+        """ A rollup tier in seconds, 0 for raw samples or None to pick one """
+        resolution = request.get('resolution')
+        if resolution is not None and resolution not in (0,) + RESOLUTIONS:
+            raise ValueError("resolution must be one of 0, 60, 600 or 3600")
+        return resolution
+
+    def live(self, msg):
+        """ Latest stored sample of every field in display units """
+        def answer(request):
+            names = request.get('sensors', list(self.sensors))
+            readings = {'timestamp': self.clock.time(), 'units': 'display'}
+            for name in names:
+                sensor = self.sensors[name]
+                readings[name] = {}
+                for key, buffer in sensor.data.items():
+                    latest = buffer.latest()
+                    if latest is not None:
+                        readings[name][key] = round(sensor.display(key, latest), 1)
+            return json.dumps(readings), "application/json"
+        self.handle(msg, "live", answer)
+
+    def summary(self, msg):
+        """ Count, min, max and mean of one field over a time range """
+        def answer(request):
+            sensor, field = self.series(request)
+            start, end = self.time_range(request)
+            hal = self.sensors[sensor]
+            result = self.history.summary(hal.label, field, start, end,
+                                          self.resolution(request))
+            if result is not None:
+                # display conversions are increasing, so they keep min and max
+                for key in ('min', 'max', 'mean'):
+                    result[key] = round(hal.display(field, result[key]), 2)
+            return json.dumps({'sensor': sensor, 'field': field, 'units': 'display',
+                               'start': start, 'end': end,
+                               'summary': result}), "application/json"
+        self.handle(msg, "summary", answer)
+
+    def history_samples(self, msg):
+        """ zlib compressed JSON rows of (start, count, min, max, mean) """
+        def answer(request):
+            sensor, field = self.series(request)
+            start, end = self.time_range(request)
+            hal = self.sensors[sensor]
+            rows = [(row[0], row[1]) + tuple(round(hal.display(field, value), 2)
+                                             for value in row[2:])
+                    for row in self.history.query(hal.label, field, start, end,
+                                                  self.resolution(request))]
+            body = json.dumps({'sensor': sensor, 'field': field, 'units': 'display',
+                               'columns': ['start', 'count', 'min', 'max', 'mean'],
+                               'rows': rows}, separators=(',', ':'))
+            return zlib.compress(body.encode('utf-8')), "application/zlib"
+        self.handle(msg, "history", answer)
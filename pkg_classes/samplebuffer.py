@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+""" Fixed capacity sample store with one pass statistics """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import math
+from array import array
+
+# NumPy is optional, it vectorizes the statistics when it is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class SampleBuffer:
+    """ Ring buffer of float samples backed by array('d'). Appending never
+        allocates and the oldest sample is overwritten once the buffer is full.
+    """
+
+    __slots__ = ('values', 'capacity', 'count', 'head', 'total')
+
+    def __init__(self, capacity):
+        """ Allocate the storage once for the life of the buffer """
+        self.values = array('d', bytes(8 * capacity))
+        self.capacity = capacity
+        self.count = 0
+        self.head = 0
+        self.total = 0.0
+
+    def __len__(self,):
+        """ Number of samples currently held """
+        return self.count
+
+    def clear(self,):
+        """ Start a new set of samples without releasing the storage """
+        self.count = 0
+        self.head = 0
+        self.total = 0.0
+
+    def append(self, value):
+        """ O(1) append that keeps a running total for the mean """
+        if self.count == self.capacity:
+            self.total -= self.values[self.head]
+        else:
+            self.count += 1
+        self.values[self.head] = value
+        self.total += value
+        self.head = (self.head + 1) % self.capacity
+
+    def latest(self,):
+        """ The most recent sample, None when empty """
+        if self.count == 0:
+            return None
+        return self.values[self.head - 1]
+
+    def mean(self,):
+        """ Mean of the samples held, zero when empty """
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def statistics(self,):
+        """ Mean, min, max, sample standard deviation and median """
+        if self.count == 0:
+            return {'samples': 0, 'mean': 0.0, 'min': 0.0, 'max': 0.0,
+                    'stddev': 0.0, 'median': 0.0}
+        if numpy is not None:
+            data = numpy.frombuffer(self.values, dtype=numpy.float64, count=self.count)
+            stddev = float(data.std(ddof=1)) if self.count > 1 else 0.0
+            return {'samples': self.count, 'mean': float(data.mean()),
+                    'min': float(data.min()), 'max': float(data.max()),
+                    'stddev': stddev, 'median': float(numpy.median(data))}
+        # Welford's single pass mean and variance with min and max
+        mean = 0.0
+        sum_squares = 0.0
+        low = high = self.values[0]
+        for index in range(self.count):
+            value = self.values[index]
+            delta = value - mean
+            mean += delta / (index + 1)
+            sum_squares += delta * (value - mean)
+            if value < low:
+                low = value
+            elif value > high:
+                high = value
+        stddev = math.sqrt(sum_squares / (self.count - 1)) if self.count > 1 else 0.0
+        ordered = sorted(self.values[:self.count])
+        half = self.count // 2
+        if self.count % 2:
+            median = ordered[half]
+        else:
+            median = (ordered[half - 1] + ordered[half]) / 2.0
+        return {'samples': self.count, 'mean': mean, 'min': low, 'max': high,
+                'stddev': stddev, 'median': median}
+
+class BoxcarDecimator:
+    """ Boxcar low-pass filter that averages every factor raw readings into one
+        decimated sample, while keeping the raw extremes so short events are
+        not lost by the averaging.
+    """
+
+    __slots__ = ('factor', 'total', 'count', 'low', 'high')
+
+    def __init__(self, factor):
+        """ A factor of one passes every reading straight through """
+        self.factor = factor
+        self.total = 0.0
+        self.count = 0
+        self.low = math.inf
+        self.high = -math.inf
+
+    def clear(self,):
+        """ Forget the partial bucket and the raw extremes """
+        self.total = 0.0
+        self.count = 0
+        self.low = math.inf
+        self.high = -math.inf
+
+    def add(self, value):
+        """ Mean of the bucket when it is complete, otherwise None """
+        if value < self.low:
+            self.low = value
+        if value > self.high:
+            self.high = value
+        self.total += value
+        self.count += 1
+        if self.count < self.factor:
+            return None
+        mean = self.total / self.count
+        self.total = 0.0
+        self.count = 0
+        return mean
+
+    def flush(self,):
+        """ Mean of a partial bucket, or None when it is empty """
+        if self.count == 0:
+            return None
+        mean = self.total / self.count
+        self.total = 0.0
+        self.count = 0
+        return mean
+
+class HampelFilter:
+    """ Streaming Hampel identifier over the last window readings. A reading
+        further from their median than threshold scaled median absolute
+        deviations, or floor when the readings are flat, is an outlier.
+        Only an isolated spike is rejected: when the next reading is beyond
+        the same side of the median the step is real, that reading is
+        accepted and the window restarts from the new level.
+    """
+
+    __slots__ = ('values', 'window', 'count', 'head', 'threshold', 'floor', 'suspect')
+
+    # scales the median absolute deviation to a standard deviation
+    MAD_SCALE = 1.4826
+
+    def __init__(self, window, threshold, floor=0.0):
+        """ Allocate the window once, it holds at most window readings """
+        self.values = array('d', bytes(8 * window))
+        self.window = window
+        self.count = 0
+        self.head = 0
+        self.threshold = threshold
+        self.floor = floor
+        # the last reading when it was rejected, None after an accepted one
+        self.suspect = None
+
+    def clear(self,):
+        """ Forget the recent readings """
+        self.count = 0
+        self.head = 0
+        self.suspect = None
+
+    def append(self, value):
+        """ Add a reading to the window, replacing the oldest when full """
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.window
+        if self.count < self.window:
+            self.count += 1
+
+    def check(self, value):
+        """ True when value agrees with the recent readings or confirms a
+            step. Everything is accepted until the window holds three readings.
+        """
+        if self.count >= 3:
+            recent = self.values[:self.count]
+            median = middle(sorted(recent))
+            distance = abs(value - median)
+            # the deviation is only needed for readings beyond the floor
+            if distance > self.floor:
+                deviation = middle(sorted(abs(item - median) for item in recent))
+                if distance > self.threshold * self.MAD_SCALE * deviation:
+                    suspect = self.suspect
+                    if suspect is None or (suspect - median) * (value - median) <= 0.0:
+                        self.suspect = value
+                        return False
+                    # two readings in a row beyond the same side, a real step
+                    self.clear()
+                    self.append(suspect)
+        self.suspect = None
+        self.append(value)
+        return True
+
+def middle(ordered):
+    """ Median of a sorted sequence """
+    half = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[half]
+    return (ordered[half - 1] + ordered[half]) / 2.0
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+""" Asyncio sampling engine for sensors, publishing and web updates """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import concurrent.futures
+import logging
+import math
+import time
+
+from pkg_classes.scheduler import Scheduler
+
+class SamplingEngine:
+    """ Run sampling, averaging, publishing and Django updates as separate
+        scheduled jobs. Sampling stays on the event loop, while slow work is
+        handed to single threaded executor lanes so it never delays a sample.
+        The loop sleeps exactly until the next deadline in the scheduler.
+    """
+
+    def __init__(self, report_interval=600.0, clock=time):
+        """ Prepare the scheduler, executor lanes and jitter statistics. clock
+            replaces the time module, for example with a virtual clock.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.clock = clock
+        self.scheduler = Scheduler(clock)
+        self.loop = None
+        self.wakeup = None
+        self.lanes = {}
+        self.busy = {}
+        self.jitter = {}
+        self.scheduler.add_periodic("jitter report", report_interval, self.report,
+                                    delay=report_interval)
+
+    def add_task(self, name, interval, method, lane=None, delay=0.0):
+        """ Register a task that runs every interval seconds. An interval of
+            None runs the task once. Tasks without a lane run on the loop.
+        """
+        self.scheduler.add_periodic(name, interval, method, lane, delay)
+        self.wake()
+
+    def add_cron(self, name, minutes, method, lane=None, offset=0.0):
+        """ Register a task that runs at the given minutes past each hour """
+        self.scheduler.add_cron(name, minutes, method, lane, offset)
+        self.wake()
+
+    def wake(self,):
+        """ Let a sleeping loop see a job that was just added """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def submit(self, name, method, lane):
+        """ Run method on an executor lane unless a job with the same name is
+            still running. Without a running loop the method is called inline.
+        """
+        if self.loop is None:
+            method()
+            return True
+        if self.busy.get(name, False):
+            self.logger.info("Skipped "+name+", previous run still active")
+            return False
+        if lane not in self.lanes:
+            self.lanes[lane] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=lane)
+        self.busy[name] = True
+        future = self.loop.run_in_executor(self.lanes[lane], method)
+        future.add_done_callback(lambda done: self.job_done(name, done))
+        return True
+
+    def job_done(self, name, future):
+        """ Clear the busy flag and log any exception raised by the job """
+        self.busy[name] = False
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(name+" failed: "+repr(future.exception()))
+
+    def record_jitter(self, name, late):
+        """ Welford running mean and variance of the lateness of a task """
+        stats = self.jitter.setdefault(name, {"samples": 0, "mean": 0.0, "m2": 0.0, "max": 0.0})
+        stats["samples"] += 1
+        delta = late - stats["mean"]
+        stats["mean"] += delta / stats["samples"]
+        stats["m2"] += delta * (late - stats["mean"])
+        stats["max"] = max(stats["max"], late)
+
+    def jitter_report(self,):
+        """ Scheduling jitter per task in milliseconds """
+        report = {}
+        for name, stats in self.jitter.items():
+            variance = 0.0
+            if stats["samples"] > 1:
+                variance = stats["m2"] / (stats["samples"] - 1)
+            job = self.scheduler.jobs.get(name)
+            report[name] = {
+                "samples": stats["samples"],
+                "mean_ms": round(stats["mean"] * 1000.0, 3),
+                "stddev_ms": round(math.sqrt(variance) * 1000.0, 3),
+                "max_ms": round(stats["max"] * 1000.0, 3),
+                "missed": job.missed if job is not None else 0
+            }
+        return report
+
+    def report(self,):
+        """ Log the jitter report """
+        self.logger.info("Jitter: "+str(self.jitter_report()))
+
+    def run_task(self, name, method, lane):
+        """ Run one task either inline or on its executor lane """
+        if lane is not None:
+            self.submit(name, method, lane)
+            return
+        try:
+            method()
+        except Exception as err: # pylint: disable=broad-except
+            self.logger.error(name+" failed: "+repr(err))
+
+    def run_due(self,):
+        """ Run every job that is due and record how late it started """
+        for job, late in self.scheduler.pop_due():
+            self.record_jitter(job.name, late)
+            self.run_task(job.name, job.method, job.lane)
+
+    async def run(self,):
+        """ Sleep until the next deadline, run the due jobs, repeat """
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.scheduler.next_delay())
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                self.run_due()
+        finally:
+            for executor in self.lanes.values():
+                executor.shutdown(wait=False)
+
+    def start(self,):
+        """ Run the engine forever on a new event loop """
+        asyncio.run(self.run())
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+""" Monotonic heap scheduler for periodic and minute-of-hour jobs """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import heapq
+import itertools
+import time
+
+# a minute-of-hour job popped this late has missed its slot
+CRON_TOLERANCE = 60.0
+
+class Job:
+    """ A job that runs every period seconds, at minutes past each hour, or
+        once when it has neither.
+    """
+
+    def __init__(self, name, method, lane, period=None, minutes=(), offset=0.0):
+        """ Timing is filled in by the scheduler """
+        self.name = name
+        self.method = method
+        self.lane = lane
+        self.period = period
+        self.minutes = tuple(sorted(set(minutes)))
+        self.offset = offset
+        self.deadline = 0.0
+        self.wall = 0.0
+        self.last_run = None
+        self.missed = 0
+        # smallest spacing between two slots, used to refuse a double run
+        self.min_gap = 3600.0
+        if len(self.minutes) > 1:
+            gaps = [later - earlier for earlier, later in
+                    zip(self.minutes, self.minutes[1:] + (self.minutes[0] + 60,))]
+            self.min_gap = 60.0 * min(gaps)
+
+class Scheduler:
+    """ Keeps jobs in a heap ordered by monotonic deadline so the caller can
+        sleep exactly until the next one. Minute-of-hour jobs are planned from
+        the wall clock but wait on the monotonic clock, and are planned again
+        when the wall clock is changed.
+    """
+
+    def __init__(self, clock=time, catch_up=True):
+        """ catch_up runs a late job once instead of skipping its slot """
+        self.clock = clock
+        self.catch_up = catch_up
+        self.heap = []
+        self.sequence = itertools.count()
+        self.jobs = {}
+
+    def push(self, job):
+        """ Queue the job at its deadline """
+        heapq.heappush(self.heap, (job.deadline, next(self.sequence), job))
+
+    def add_periodic(self, name, period, method, lane=None, delay=0.0):
+        """ Run every period seconds, first after delay. A period of None
+            runs the job once.
+        """
+        job = Job(name, method, lane, period=period)
+        job.deadline = self.clock.monotonic() + delay
+        self.jobs[name] = job
+        self.push(job)
+        return job
+
+    def add_cron(self, name, minutes, method, lane=None, offset=0.0):
+        """ Run at the given minutes past every hour, plus offset seconds """
+        if not minutes:
+            raise ValueError("minute-of-hour job "+name+" needs at least one minute")
+        job = Job(name, method, lane, minutes=minutes, offset=offset)
+        self.plan(job)
+        self.jobs[name] = job
+        self.push(job)
+        return job
+
+    def next_wall(self, job, after):
+        """ First wall time after the given one that matches the job minutes """
+        fields = self.clock.localtime(after)
+        hour_start = after - fields.tm_min * 60 - fields.tm_sec - (after % 1.0)
+        # the offset can move a slot of an earlier hour past after
+        hour_start -= 3600.0 * (1 + int(abs(job.offset) // 3600.0))
+        while True:
+            for minute in job.minutes:
+                candidate = hour_start + minute * 60.0 + job.offset
+                if candidate > after:
+                    return candidate
+            hour_start += 3600.0
+
+    def plan(self, job):
+        """ Convert the next wall time slot to a monotonic deadline """
+        now = self.clock.time()
+        job.wall = self.next_wall(job, now)
+        job.deadline = self.clock.monotonic() + (job.wall - now)
+
+    def next_delay(self,):
+        """ Seconds until the earliest deadline, None without jobs """
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - self.clock.monotonic())
+
+    def reschedule(self, job, deadline, now):
+        """ Queue the next run, coalescing periods that were missed """
+        if job.minutes:
+            self.plan(job)
+        elif job.period is not None:
+            job.deadline = deadline + job.period
+            if job.deadline <= now:
+                missed = int((now - job.deadline) // job.period) + 1
+                job.missed += missed
+                job.deadline += missed * job.period
+        else:
+            self.jobs.pop(job.name, None)
+            return
+        self.push(job)
+
+    def pop_due(self,):
+        """ Jobs that are due with their lateness in seconds, each job is
+            queued again before it is returned.
+        """
+        due = []
+        now = self.clock.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, job = heapq.heappop(self.heap)
+            if job.minutes and self.clock.time() < job.wall - 1.0:
+                # the wall clock moved back while waiting
+                self.plan(job)
+                self.push(job)
+                continue
+            late = now - deadline
+            run = True
+            if job.minutes:
+                if late > CRON_TOLERANCE:
+                    job.missed += 1
+                    run = self.catch_up
+                if job.last_run is not None and now - job.last_run < job.min_gap / 2.0:
+                    # the wall clock moved forward onto a slot that already ran
+                    run = False
+            elif job.period is not None and late > job.period:
+                run = self.catch_up
+            if run:
+                job.last_run = now
+                due.append((job, late))
+            self.reschedule(job, deadline, now)
+        return due
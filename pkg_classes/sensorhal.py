@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+""" Common sensor HAL interface and lazily imported sensor registry """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# pylint: disable=too-many-instance-attributes
+
+import importlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+import logging
+
+from pkg_classes.deadband import DeadbandFilter
+from pkg_classes.metricsmodel import METRICS
+from pkg_classes.samplebuffer import BoxcarDecimator, HampelFilter, SampleBuffer
+
+# smallest averaging window, it grows to hold every sample between publishes
+SAMPLE_CAPACITY = 360
+
+# seconds to wait before trying to open a missing sensor again
+RETRY_INTERVAL = 60.0
+
+# attempts at a failed bus read and the first backoff in seconds, doubled
+# after each attempt
+READ_ATTEMPTS = 3
+READ_BACKOFF = 0.02
+
+# sensor name to HAL module and class, modules are imported only when used
+SENSOR_REGISTRY = {
+    'bme680': ('pkg_classes.bme680hal', 'Bme680HAL'),
+    'veml7700': ('pkg_classes.veml7700hal', 'Veml7700HAL'),
+}
+
+# open buses and TCA9548A multiplexers, shared by every sensor on them
+I2C_BUSES = {}
+
+def get_i2c(bus=None, mux=None, channel=None):
+    """ Open an I2C bus on first use. bus is a Linux bus number or None for
+        the board SCL and SDA pins, mux and channel select a TCA9548A port.
+    """
+    # pylint: disable=import-outside-toplevel
+    if bus not in I2C_BUSES:
+        if bus is None:
+            import board
+            import busio
+            I2C_BUSES[bus] = busio.I2C(board.SCL, board.SDA)
+        else:
+            from adafruit_extended_bus import ExtendedI2C
+            I2C_BUSES[bus] = ExtendedI2C(bus)
+    if mux is None:
+        return I2C_BUSES[bus]
+    if (bus, mux) not in I2C_BUSES:
+        import adafruit_tca9548a
+        I2C_BUSES[(bus, mux)] = adafruit_tca9548a.TCA9548A(I2C_BUSES[bus], mux)
+    return I2C_BUSES[(bus, mux)][channel]
+
+def instance_path(path, instance):
+    """ Give each gateway instance its own file, e.g. history-office.db """
+    if path is None or path == ':memory:':
+        return path
+    root, extension = os.path.splitext(path)
+    return root+"-"+instance+extension
+
+def size_of(*objects):
+    """ Estimated bytes held by objects and everything they contain, for
+        containers, arrays and slotted or plain objects. Each object is
+        counted once.
+    """
+    seen = set()
+    pending = list(objects)
+    total = 0
+    while pending:
+        item = pending.pop()
+        if item is None or id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set)):
+            pending.extend(item)
+        elif hasattr(item, '__slots__'):
+            pending.extend(getattr(item, name) for name in item.__slots__)
+        elif hasattr(item, '__dict__'):
+            pending.append(vars(item))
+    return total
+
+def create_sensor(name, client, topic):
+    """ Import and construct a sensor HAL by its registry name """
+    module_name, class_name = SENSOR_REGISTRY[name]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(client, topic)
+
+class SensorHAL:
+    """ Base class for every sensor. The driver is created on first use so a
+        missing chip only disables its own HAL. Subclasses provide open_sensor,
+        read_sample and, when needed, compute_derived and display.
+    """
+
+    name = 'sensor'
+
+    # plausible (low, high) reading per field, anything outside is a bus glitch
+    limits = {}
+
+    # smallest deviation the outlier filter treats as an outlier per field
+    floors = {}
+
+    def __init__(self, client, topic, fields, outputs):
+        """ Sample buffers for the measured fields, averages for the outputs """
+        self.logger = logging.getLogger(type(self).__module__)
+        self.logger.info('Application started')
+        self.client = client
+        self.topic = topic
+        self.sensor = None
+        self.retry_time = 0.0
+        self.clock = time
+        self.engine = None
+        self.data = {key: SampleBuffer(SAMPLE_CAPACITY) for key in fields}
+        self.decimators = {key: BoxcarDecimator(1) for key in fields}
+        self.statistics = {}
+        self.averages = {key: 0.0 for key in outputs}
+        self.dict = {key: '0.0' for key in outputs}
+        self.samples = 0
+        self.deadband = None
+        self.history = None
+        # held for every driver access, calibration reads from another thread
+        self.reading = threading.Lock()
+        self.outliers = {}
+        self.rejected = {key: 0 for key in fields}
+        # I2C bus, multiplexer and channel, and the name used in metrics
+        self.bus = (None, None, None)
+        self.label = self.name
+
+    def configure(self, config):
+        """ Apply per node settings from the ConfigModel """
+        self.set_capacity(config.get_window_capacity())
+        self.set_decimation(config.get_sampling()[1])
+        self.set_outlier_filter(*config.get_outlier_filter())
+        enabled, deadbands, heartbeat = config.get_deadband()
+        if enabled:
+            self.set_deadband(DeadbandFilter(deadbands, heartbeat))
+
+    def apply_settings(self, sensor):
+        """ Write configured driver settings such as gain or oversampling """
+
+    def opened(self, sensor):
+        """ Called once the driver is ready, for example to restore state """
+
+    def open_sensor(self,):
+        """ Create the bus and driver for this sensor """
+        raise NotImplementedError
+
+    def set_sensor(self, sensor):
+        """ Use an existing driver, such as a simulated sensor """
+        self.sensor = sensor
+        self.apply_settings(sensor)
+        self.opened(sensor)
+
+    def set_capacity(self, capacity):
+        """ Size the window buffers for capacity stored samples, so a window
+            never overwrites its own oldest samples
+        """
+        capacity = max(SAMPLE_CAPACITY, capacity)
+        self.data = {key: SampleBuffer(capacity) for key in self.data}
+
+    def set_decimation(self, factor):
+        """ Average every factor raw readings into one sample in the window """
+        self.decimators = {key: BoxcarDecimator(factor) for key in self.data}
+
+    def set_bus(self, bus=None, mux=None, channel=None):
+        """ Open the driver on another I2C bus or behind a multiplexer """
+        self.bus = (bus, mux, channel)
+
+    def set_instance(self, instance):
+        """ Label this sensor with its gateway instance so several sensors of
+            the same kind can share a process
+        """
+        self.label = instance+"/"+self.name
+
+    def set_outlier_filter(self, window, threshold):
+        """ Hampel filter every field over window readings, 0 checks only
+            the plausible range
+        """
+        self.outliers = {}
+        if window > 0:
+            self.outliers = {key: HampelFilter(window, threshold, self.floors.get(key, 0.0))
+                             for key in self.data}
+
+    def set_deadband(self, deadband):
+        """ Report by exception, None publishes every field every time """
+        self.deadband = deadband
+
+    def set_history(self, history):
+        """ Record every decimated sample in a HistoryModel """
+        self.history = history
+
+    def set_clock(self, clock):
+        """ Replace the time module, for example with a virtual clock """
+        self.clock = clock
+
+    def set_engine(self, engine):
+        """ Wait out a read backoff on the sampling engine instead of sleeping """
+        self.engine = engine
+
+    def get_sensor(self,):
+        """ Open the driver on first use and retry a missing chip later """
+        if self.sensor is None and self.clock.monotonic() >= self.retry_time:
+            with self.reading:
+                if self.sensor is None:
+                    self.open_driver()
+        return self.sensor
+
+    def open_driver(self,):
+        """ Open and set up the driver, or try again after RETRY_INTERVAL """
+        try:
+            sensor = self.open_sensor()
+            self.apply_settings(sensor)
+            self.opened(sensor)
+            self.sensor = sensor
+            self.logger.info(self.name+" sensor opened")
+        except (ImportError, OSError, RuntimeError, ValueError) as err:
+            self.retry_time = self.clock.monotonic() + RETRY_INTERVAL
+            self.logger.error(self.name+" sensor unavailable: "+repr(err))
+
+    def calibrate(self, cancel=None, progress=None):
+        """ Sensors without a calibration procedure do nothing. A calibration
+            stops when the cancel event is set, reports 0 to 1 to progress and
+            returns False when it did not complete.
+        """
+        # pylint: disable=unused-argument
+        return True
+
+    def run_calibration(self, cancel=None, progress=None):
+        """ calibrate and record how long it took """
+        with METRICS.timer('calibrate', self.label):
+            return self.calibrate(cancel, progress)
+
+    def new_samples(self,):
+        """ initialize a new set of samples """
+        for buffer in self.data.values():
+            buffer.clear()
+        for decimator in self.decimators.values():
+            decimator.clear()
+        for key in self.rejected:
+            self.rejected[key] = 0
+        self.samples = 0
+
+    def add_value(self, key, value):
+        """ Decimate one raw reading into the window buffer """
+        sample = self.decimators[key].add(value)
+        if sample is not None:
+            self.data[key].append(sample)
+            if self.history is not None:
+                self.history.record(self.label, key, self.clock.time(), sample)
+
+    def read_sample(self, sensor):
+        """ One reading of every measured field as a dictionary """
+        raise NotImplementedError
+
+    def read_retry(self, sensor, attempt):
+        """ Read every field, None after a bus error. A failed read is tried
+            again after a backoff, as a one shot engine task so the loop keeps
+            running other jobs meanwhile, or after a sleep without an engine
+        """
+        try:
+            with self.reading:
+                return self.read_sample(sensor)
+        except (OSError, RuntimeError, ValueError) as err:
+            METRICS.inc('diyha_i2c_errors_total', {'sensor': self.label})
+            if attempt + 1 == READ_ATTEMPTS:
+                self.logger.warning(self.name+" read failed: "+repr(err))
+                return None
+        delay = READ_BACKOFF * 2.0 ** attempt
+        if self.engine is None:
+            self.clock.sleep(delay)
+            return self.read_retry(sensor, attempt + 1)
+        self.engine.add_task("retry "+self.label, None,
+                             lambda: self.store_sample(sensor, attempt + 1), delay=delay)
+        return None
+
+    def accept(self, key, value):
+        """ False for a reading outside the plausible range or an outlier """
+        low, high = self.limits.get(key, (-math.inf, math.inf))
+        if not low <= value <= high:
+            reason = 'range'
+        elif key in self.outliers and not self.outliers[key].check(value):
+            reason = 'outlier'
+        else:
+            return True
+        self.rejected[key] += 1
+        METRICS.inc('diyha_samples_rejected_total',
+                    {'sensor': self.label, 'field': key, 'reason': reason})
+        self.logger.debug("{0} {1} {2} rejected: {3!r}".format(self.name, key, reason, value))
+        return False
+
+    def collect_sample(self,):
+        """ capture one data sample, rejected readings leave the window """
+        sensor = self.get_sensor()
+        if sensor is not None:
+            self.store_sample(sensor, 0)
+
+    def store_sample(self, sensor, attempt):
+        """ Read the sensor and add the accepted readings to the window """
+        started = time.perf_counter()
+        values = self.read_retry(sensor, attempt)
+        if values is None:
+            return
+        METRICS.observe('diyha_stage_seconds', time.perf_counter() - started,
+                        {'stage': 'collect', 'sensor': self.label})
+        for key, value in values.items():
+            if self.accept(key, value):
+                self.add_value(key, value)
+        self.samples += 1
+        if self.deadband is not None:
+            self.publish_exceptions()
+
+    def publish_exceptions(self,):
+        """ Publish a field out of cycle as soon as its latest decimated
+            sample moves well beyond the deadband of the last published value
+        """
+        now = self.clock.time()
+        for key, buffer in self.data.items():
+            latest = buffer.latest()
+            if latest is None:
+                continue
+            value = round(self.display(key, latest), 1)
+            if self.deadband.significant(key, value):
+                self.client.publish(self.topic+"/"+key, "{0:.1f}".format(value), 0, True)
+                self.deadband.published(key, value, now)
+                self.logger.info(key+" changed to {0:.1f}".format(value))
+
+    def memory_bytes(self,):
+        """ Estimated bytes of the sampling state this sensor owns: window
+            buffers, decimators, outlier filters, averages, statistics and
+            the last published values. The driver, client and history are
+            shared or external and not counted.
+        """
+        last = None if self.deadband is None else self.deadband.last
+        return size_of(self.data, self.decimators, self.outliers, self.rejected,
+                       self.averages, self.dict, self.statistics, last)
+
+    def compute_derived(self,):
+        """ Outputs computed from the averages of the measured fields """
+
+    def average_samples(self,):
+        """ compute averages and statistics based on number of samples """
+        if self.samples > 0:
+            for key, buffer in self.data.items():
+                decimator = self.decimators[key]
+                partial = decimator.flush()
+                if partial is not None:
+                    buffer.append(partial)
+                statistics = buffer.statistics()
+                if statistics['samples'] == 0:
+                    # every reading was rejected, hold the last average
+                    held = self.averages.get(key, 0.0)
+                    statistics.update(mean=held, min=held, max=held, median=held)
+                    decimator.low = decimator.high = held
+                # raw extremes catch events shorter than a decimated sample
+                statistics['peak_min'] = decimator.low
+                statistics['peak_max'] = decimator.high
+                statistics['rejected'] = self.rejected[key]
+                self.statistics[key] = statistics
+                self.averages[key] = statistics['mean']
+            self.compute_derived()
+        self.new_samples()
+
+    def display(self, key, value):
+        """ Convert one value from sensor units to display units """
+        # pylint: disable=unused-argument
+        return value
+
+    def format_samples(self,):
+        """ convert the averages to display units in self.dict """
+        for key, value in self.averages.items():
+            self.dict[key] = "{0:.1f}".format(self.display(key, value))
+
+    def publish_samples(self,):
+        """ publish data, only changed fields or heartbeats in report by exception """
+        self.format_samples()
+        now = self.clock.time()
+        published = False
+        for key, info in self.dict.items():
+            if self.deadband is not None:
+                if not self.deadband.should_publish(key, float(info), now):
+                    continue
+                self.deadband.published(key, float(info), now)
+            self.client.publish(self.topic+"/"+key, info, 0, True)
+            published = True
+        # full summary of the averaging window in sensor units
+        if published:
+            self.client.publish(self.topic+"/"+self.name+"/statistics",
+                                json.dumps(self.statistics), 0, True)
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+""" The whole sensor node on one MQTT connection and one engine """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import time
+
+from pkg_classes.calibrationjob import CalibrationJob
+from pkg_classes.gatewaymodel import GatewayInstance
+from pkg_classes.historymodel import HistoryModel
+from pkg_classes.spoolmodel import SpoolModel
+from pkg_classes.topicmodel import TopicModel
+
+class SensorNode:
+    """ Everything sensor.py runs once the MQTT client, Django model, topic
+        dispatcher and engine exist: the spool, the history, one
+        GatewayInstance per location, queries and remote calibration on the
+        dispatcher, and the sampling, publishing, replay and history jobs on
+        the engine. The simulator builds the same node on a virtual clock.
+    """
+
+    def __init__(self, config, client, django, dispatcher, engine, clock=time):
+        """ Wire the node, nothing runs until the client and engine start """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.django = django
+        self.dispatcher = dispatcher
+        self.engine = engine
+        client.add_connect_callback(self.subscribe)
+        client.set_message_callback(self.on_message)
+        # readings that can not be delivered are spooled and replayed later
+        self.spool = SpoolModel(client, *config.get_spool())
+        self.spool.set_clock(clock)
+        django.set_spool(self.spool)
+        # optionally keep every sample and its rollups on the node
+        path, retention = config.get_history()
+        self.history = None
+        if path is not None:
+            self.history = HistoryModel(path, retention)
+            self.history.set_clock(clock)
+        # a gateway serves many locations over one connection, one Django
+        # session and one scheduler
+        self.instances = []
+        self.sensors = []
+        for instance in config.get_instances():
+            location = GatewayInstance(config, instance, client, self.spool, django,
+                                       self.history, config.get_gateway(), clock)
+            if config.get_gateway():
+                django.add_location(location.name)
+            # answer live, summary and history queries under the location topic
+            for topic, method in location.query.get_handlers().items():
+                dispatcher.register(topic, method)
+            self.instances.append(location)
+            self.sensors.extend(location.sensors)
+        # diy/system/calibrate runs a cancellable calibration in the background
+        topic = TopicModel()
+        topic.set(config.get_location())
+        self.calibration = CalibrationJob(client, topic.get_status_topic()+"/calibration",
+                                          self.sensors)
+        self.calibration.set_clock(clock)
+        dispatcher.register("diy/system/calibrate", self.calibration.handle)
+        self.schedule(config)
+
+    def schedule(self, config):
+        """ sampling runs on the event loop, slow work runs on executor lanes """
+        engine = self.engine
+        engine.add_task("connect check", None, self.check_connected, delay=30.0)
+        for sensor in self.sensors:
+            engine.add_task("calibrate "+sensor.label, None, sensor.run_calibration,
+                            lane="calibrate")
+        sample_rate, _ = config.get_sampling()
+        engine.add_task("sample", 1.0 / sample_rate, self.collect_samples)
+        for location in self.instances:
+            location.start(engine, config)
+        if config.get_gateway():
+            engine.add_task("gateway report", 3600.0, self.report_instances, lane="io",
+                            delay=3600.0)
+        engine.add_task("replay", 1.0, self.spool.replay, lane="io")
+        if self.history is not None:
+            engine.add_task("history", 60.0, self.history.flush, lane="io")
+
+    def subscribe(self, client):
+        """ Subscribing after every connect renews the subscriptions when
+            the connection is lost and made again
+        """
+        for topic in self.dispatcher.get_subscriptions():
+            client.subscribe(topic, 1)
+
+    def on_message(self, client, userdata, msg):
+        """ dispatch to the appropriate MQTT topic handler """
+        # pylint: disable=unused-argument
+        self.dispatcher.dispatch(msg)
+
+    def check_connected(self,):
+        """ warn once when the broker could not be reached at boot """
+        if not self.client.is_connected():
+            self.logger.warning("MQTT broker unreachable, spooling until it connects")
+
+    def collect_samples(self,):
+        """ capture one sample from every sensor """
+        for location in self.instances:
+            location.collect_samples()
+
+    def report_instances(self,):
+        """ log the CPU time and buffer size of every gateway instance """
+        for location in self.instances:
+            location.report()
+
+    def collect_metrics(self,):
+        """ gauges read when the metrics are scraped """
+        yield ('diyha_queue_depth', {'queue': 'django'}, len(self.django.pending))
+        yield ('diyha_spool_bytes', {}, self.spool.size)
+        for pattern, handlers in self.dispatcher.handlers.items():
+            for handler in handlers:
+                yield ('diyha_queue_depth', {'queue': pattern}, handler.queue.qsize())
+        for sensor in self.sensors:
+            for key, value in sensor.averages.items():
+                yield ('diyha_sensor_value', {'sensor': sensor.label, 'field': key}, value)
+        for location in self.instances:
+            yield ('diyha_instance_cpu_seconds_total', {'location': location.name},
+                   location.meter.seconds)
+            yield ('diyha_instance_memory_bytes', {'location': location.name},
+                   location.memory_bytes())
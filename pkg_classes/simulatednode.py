@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+""" A complete sensor node wired to simulated hardware, broker and server """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import queue
+import threading
+
+from pkg_classes.connectionmodel import ConnectionModel
+from pkg_classes.djangomodel import DjangoModel
+from pkg_classes.samplingengine import SamplingEngine
+from pkg_classes.sensornode import SensorNode
+from pkg_classes.simulatedsensors import FakeMqttClient, FakeSession
+from pkg_classes.topicdispatcher import TopicDispatcher
+from pkg_classes.topicmodel import TopicModel
+
+class VirtualEngine(SamplingEngine):
+    """ SamplingEngine stepped by the simulator on a VirtualClock. Lane jobs
+        run in order on one thread per lane as in the node, but time only
+        moves on once every lane is idle or its job is asleep on the clock,
+        so a replay is the same every time. Lane threads are daemons so a
+        job still asleep at the end does not hold up the exit.
+    """
+
+    def __init__(self, clock):
+        """ No lane has work yet """
+        super().__init__(clock=clock)
+        self.queued = {}
+        self.running = {}
+
+    def submit(self, name, method, lane):
+        """ Queue method on its lane and wait until the lanes settle """
+        if self.busy.get(name, False):
+            self.logger.info("Skipped "+name+", previous run still active")
+            return False
+        if lane not in self.lanes:
+            self.lanes[lane] = queue.Queue()
+            threading.Thread(target=self.run_lane, args=(lane,), daemon=True,
+                             name=lane).start()
+        with self.clock.condition:
+            self.busy[name] = True
+            self.queued[lane] = self.queued.get(lane, 0) + 1
+        self.lanes[lane].put((name, method))
+        self.settle()
+        return True
+
+    def run_lane(self, lane):
+        """ Run the jobs of one lane in order, logging any exception """
+        while True:
+            name, method = self.lanes[lane].get()
+            with self.clock.condition:
+                self.running[lane] = threading.get_ident()
+            try:
+                method()
+            except Exception as err: # pylint: disable=broad-except
+                self.logger.error(name+" failed: "+repr(err))
+            finally:
+                with self.clock.condition:
+                    self.busy[name] = False
+                    self.queued[lane] -= 1
+                    self.running[lane] = None
+                    self.clock.condition.notify_all()
+
+    def settled(self,):
+        """ True when every lane is idle or its job sleeps on the clock """
+        return all(count == 0 or self.clock.sleeping(self.running.get(lane))
+                   for lane, count in self.queued.items())
+
+    def settle(self,):
+        """ Wait for the lanes to settle """
+        with self.clock.condition:
+            self.clock.condition.wait_for(self.settled)
+
+    def advance(self, seconds):
+        """ Move the clock on, waking the lane jobs asleep on it in order """
+        until = self.clock.now + seconds
+        wake = self.clock.next_wake()
+        while wake is not None and wake <= until:
+            self.clock.wake(wake)
+            self.settle()
+            wake = self.clock.next_wake()
+        self.clock.wake(until)
+
+class SimulatedNode:
+    """ Runs the node sensor.py builds, the same SensorNode on the same
+        engine, against simulated drivers, an in process broker and Django
+        server, and steps it on a virtual clock so hours of operation run
+        in seconds.
+    """
+
+    def __init__(self, config, clock, seed=0):
+        """ Build the node, every location uses simulated drivers seeded
+            from seed
+        """
+        self.clock = clock
+        instances = config.get_instances()
+        for position, instance in enumerate(instances):
+            if not instance['simulated']:
+                instance.update(simulated=True, seed=seed + 10 * position)
+        topic = TopicModel()
+        topic.set(config.get_location())
+        self.client = FakeMqttClient(clock)
+        self.connection = ConnectionModel(config.get_broker(), topic.get_status_topic(),
+                                          *config.get_connection(), client=self.client)
+        names = [instance['location'].rpartition("/")[2] for instance in instances]
+        self.session = FakeSession(clock, *names)
+        self.django = DjangoModel()
+        self.django.set_session(self.session)
+        self.django.set_clock(clock)
+        self.django.set_urls(config.get_django_api_url(), topic.get_location_name())
+        self.engine = VirtualEngine(clock)
+        self.node = SensorNode(config, self.connection, self.django, TopicDispatcher(),
+                               self.engine, clock)
+        self.sensors = self.node.sensors
+        # ids are looked up in the background, the replay starts once they are known
+        self.django.wait_ids(10.0)
+        self.connection.start()
+
+    def step(self,):
+        """ Run the jobs that are due at the current virtual time """
+        self.engine.run_due()
+        # wait for the Django worker so PUTs are recorded in order
+        self.django.drain()
+
+    def run(self, seconds):
+        """ Jump from one deadline to the next until seconds have passed """
+        until = self.clock.monotonic() + seconds
+        delay = self.engine.scheduler.next_delay()
+        while delay is not None and self.clock.monotonic() + delay <= until:
+            self.engine.advance(delay)
+            self.step()
+            delay = self.engine.scheduler.next_delay()
+        self.engine.advance(until - self.clock.monotonic())
+
+    def records(self,):
+        """ Messages and PUTs in order. Statistics topics are left out since
+            their full precision floats differ between NumPy and pure Python,
+            and the status topic since it carries the host name.
+        """
+        records = []
+        for stamp, topic, payload, _, retain in self.client.messages:
+            if not topic.endswith("/statistics") and topic != self.connection.status_topic:
+                records.append([stamp, topic, decode(payload), retain])
+        for stamp, url, data in self.session.requests:
+            records.append([stamp, "PUT "+url, decode(data), False])
+        return records
+
+def decode(payload):
+    """ JSON payloads are compared as values, anything else as text """
+    if isinstance(payload, bytes):
+        return payload.hex()
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return payload
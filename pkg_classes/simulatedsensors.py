@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+""" Simulated sensors, MQTT client and Django server for replay and benchmarks """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import csv
+import math
+import random
+import socket
+import threading
+import time
+
+DAY = 86400.0
+
+class VirtualClock:
+    """ Stand-in for the time module that only moves when advanced. UTC is
+        used for calendar fields so replays do not depend on the time zone.
+        The thread that created the clock moves it on by sleeping, any other
+        thread sleeps until the clock is woken past its wake time.
+    """
+
+    def __init__(self, start):
+        """ Start the clock at an epoch time in seconds """
+        self.start = start
+        self.now = start
+        self.owner = threading.current_thread()
+        self.condition = threading.Condition()
+        # wake time of every other thread sleeping on the clock
+        self.wakes = {}
+
+    def advance(self, seconds):
+        """ Move virtual time forward """
+        self.wake(self.now + seconds)
+
+    def time(self,):
+        """ Virtual epoch seconds """
+        return self.now
+
+    def monotonic(self,):
+        """ Virtual seconds since the clock started """
+        return self.now - self.start
+
+    def sleep(self, seconds):
+        """ Sleeping on the owner thread just advances the clock """
+        if threading.current_thread() is self.owner:
+            self.advance(seconds)
+            return
+        ident = threading.get_ident()
+        with self.condition:
+            self.wakes[ident] = self.now + seconds
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: ident not in self.wakes)
+
+    def sleeping(self, ident):
+        """ True while the thread is asleep on the clock """
+        return ident in self.wakes
+
+    def next_wake(self,):
+        """ Earliest wake time of a sleeping thread, None when none sleeps """
+        with self.condition:
+            return min(self.wakes.values(), default=None)
+
+    def wake(self, until):
+        """ Move the clock to until and wake the threads that are due """
+        with self.condition:
+            self.now = max(self.now, until)
+            for ident, wake in list(self.wakes.items()):
+                if wake <= self.now:
+                    del self.wakes[ident]
+            self.condition.notify_all()
+
+    def localtime(self, seconds=None):
+        """ Calendar fields of the virtual time """
+        return time.gmtime(self.now if seconds is None else seconds)
+
+    def strftime(self, fmt, struct=None):
+        """ Format the virtual time like time.strftime """
+        return time.strftime(fmt, self.localtime() if struct is None else struct)
+
+def diurnal(clock, peak_hour):
+    """ Daily cosine that is 1.0 at peak_hour and -1.0 twelve hours later """
+    hours = (clock.time() % DAY) / 3600.0
+    return math.cos(2.0 * math.pi * (hours - peak_hour) / 24.0)
+
+class FakeBme680:
+    """ Synthetic BME680 with daily temperature, humidity and gas cycles. Like
+        the Adafruit driver every property read forces a new measurement of
+        all four fields unless the refresh time has not passed yet.
+    """
+
+    # pylint: disable=protected-access
+
+    def __init__(self, clock, seed=0):
+        """ Seeded noise makes every replay identical """
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.sea_level_pressure = 1013.25
+        # factory trimming, a different seed is a different chip
+        self._temp_calibration = [26000 + seed, 26000, 3]
+        self._min_refresh_time = 0.1
+        self._last_reading = -math.inf
+        self.measurements = 0
+        self.values = (0.0, 0.0, 0.0, 0.0)
+
+    def _perform_reading(self,):
+        """ one forced measurement of temperature, humidity, pressure and gas """
+        if self.clock.monotonic() - self._last_reading < self._min_refresh_time:
+            return
+        self.measurements += 1
+        weather = math.sin(2.0 * math.pi * self.clock.time() / (3.0 * DAY))
+        self.values = (
+            # degrees celsius, warmest mid afternoon
+            21.0 + 3.0 * diurnal(self.clock, 15.0) + self.random.gauss(0.0, 0.05),
+            # percent relative humidity, lowest when warmest
+            45.0 - 8.0 * diurnal(self.clock, 15.0) + self.random.gauss(0.0, 0.3),
+            # hPa with a slow three day weather cycle
+            1013.0 + 6.0 * weather + self.random.gauss(0.0, 0.05),
+            # ohms, cleanest air in the early morning
+            50000.0 + 8000.0 * diurnal(self.clock, 4.0) + self.random.gauss(0.0, 500.0))
+        self._last_reading = self.clock.monotonic()
+
+    @property
+    def temperature(self,):
+        """ degrees celsius """
+        self._perform_reading()
+        return self.values[0]
+
+    @property
+    def humidity(self,):
+        """ percent relative humidity """
+        self._perform_reading()
+        return self.values[1]
+
+    relative_humidity = humidity
+
+    @property
+    def pressure(self,):
+        """ hPa """
+        self._perform_reading()
+        return self.values[2]
+
+    @property
+    def gas(self,):
+        """ ohms """
+        self._perform_reading()
+        return self.values[3]
+
+class FakeVeml7700:
+    """ Synthetic VEML7700 following daylight, scaled by gain and integration """
+
+    # register values used by the Adafruit driver
+    ALS_GAIN_1 = 0x0
+    ALS_GAIN_2 = 0x1
+    ALS_GAIN_1_8 = 0x2
+    ALS_GAIN_1_4 = 0x3
+    ALS_25MS = 0xC
+    ALS_50MS = 0x8
+    ALS_100MS = 0x0
+    ALS_200MS = 0x1
+    ALS_400MS = 0x2
+    ALS_800MS = 0x3
+    GAIN_VALUES = {ALS_GAIN_1: 1.0, ALS_GAIN_2: 2.0, ALS_GAIN_1_8: 0.125, ALS_GAIN_1_4: 0.25}
+    INTEGRATION_VALUES = {ALS_25MS: 25.0, ALS_50MS: 50.0, ALS_100MS: 100.0,
+                          ALS_200MS: 200.0, ALS_400MS: 400.0, ALS_800MS: 800.0}
+
+    def __init__(self, clock, seed=0):
+        """ Seeded noise makes every replay identical """
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.light_gain = self.ALS_GAIN_1
+        self.light_integration_time = self.ALS_100MS
+
+    def resolution(self,):
+        """ lux per count like the Adafruit driver """
+        gain = self.GAIN_VALUES[self.light_gain]
+        integration = self.INTEGRATION_VALUES[self.light_integration_time]
+        return 0.0036 * (800.0 / integration) * (2.0 / gain)
+
+    @property
+    def light(self,):
+        """ raw ambient light counts, dark at night and brightest at noon """
+        daylight = max(0.0, diurnal(self.clock, 12.0))
+        counts = max(0.0, 20.0 + 4000.0 * daylight + self.random.gauss(0.0, 5.0))
+        # counts at the default gain and integration time rescaled to the settings
+        return min(65535.0, counts * 0.0576 / self.resolution())
+
+    @property
+    def lux(self,):
+        """ lux from the raw counts """
+        return self.light * self.resolution()
+
+class RecordedSensor:
+    """ Replays a CSV recording whose first column is a timestamp and whose
+        other columns are driver properties such as temperature or lux. The
+        recording starts with the clock and loops when it runs out.
+    """
+
+    def __init__(self, clock, path):
+        """ Load the whole recording into memory """
+        self.clock = clock
+        self.times = []
+        self.rows = []
+        with open(path, newline='') as recording:
+            for row in csv.DictReader(recording):
+                self.times.append(float(row.pop('timestamp')))
+                self.rows.append({key: float(value) for key, value in row.items()})
+        self.sea_level_pressure = 1013.25
+
+    def __getattr__(self, name):
+        """ Value of a column at the current virtual time """
+        if name == 'relative_humidity':
+            name = 'humidity'
+        if name.startswith('_') or not self.rows or name not in self.rows[0]:
+            raise AttributeError(name)
+        span = self.times[-1] - self.times[0] or 1.0
+        offset = self.times[0] + (self.clock.monotonic() % span)
+        index = 0
+        while index + 1 < len(self.times) and self.times[index + 1] <= offset:
+            index += 1
+        return self.rows[index][name]
+
+class FakeMessageInfo:
+    """ Result of a simulated publish """
+
+    def __init__(self, mid, rc):
+        """ Message id and result code like paho MQTTMessageInfo """
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self,):
+        """ Delivered as soon as it was accepted """
+        return self.rc == 0
+
+    def wait_for_publish(self, timeout=None):
+        """ Nothing to wait for in process """
+
+class FakeMqttClient:
+    """ In process stand-in for the paho client that records every publish,
+        it connects as soon as its network loop is started
+    """
+
+    def __init__(self, clock):
+        """ Connected with an empty message log """
+        self.clock = clock
+        self.connected = True
+        self.messages = []
+        self.subscriptions = []
+        self.mid = 0
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_message = None
+
+    def max_inflight_messages_set(self, inflight):
+        """ Nothing is ever in flight """
+
+    def max_queued_messages_set(self, queue_size):
+        """ Nothing is ever queued """
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        """ The simulated broker never drops the connection by itself """
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        """ The last will is never sent """
+
+    def connect_async(self, host, port=1883, keepalive=60):
+        """ Connecting happens when the loop starts """
+
+    def loop_start(self,):
+        """ Report a successful connect right away """
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self,):
+        """ There is no network thread to stop """
+
+    def disconnect(self,):
+        """ Stop accepting publishes """
+        self.connected = False
+
+    def is_connected(self,):
+        """ Toggle connected to simulate a broker outage """
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """ Record the message, fail with MQTT_ERR_NO_CONN when offline """
+        # pylint: disable=unused-argument
+        self.mid += 1
+        if not self.connected:
+            return FakeMessageInfo(self.mid, 4)
+        self.messages.append((self.clock.time(), topic, payload, qos, retain))
+        return FakeMessageInfo(self.mid, 0)
+
+    def subscribe(self, topic, qos=0):
+        """ Subscriptions are recorded, nothing is ever delivered """
+        self.subscriptions.append((topic, qos))
+        return (0, self.mid)
+
+class FakeResponse:
+    """ Minimal requests.Response """
+
+    def __init__(self, status_code, body=None):
+        """ Status and decoded JSON body """
+        self.status_code = status_code
+        self.body = body
+
+    def raise_for_status(self,):
+        """ Raise requests HTTPError for 4xx and 5xx """
+        if self.status_code >= 400:
+            import requests # pylint: disable=import-outside-toplevel
+            raise requests.exceptions.HTTPError(str(self.status_code))
+
+    def json(self,):
+        """ Decoded body """
+        return self.body
+
+class FakeSession:
+    """ In process Django API that records every PUT. Listings contain this
+        host with id 1 and the locations numbered from 1 so DjangoModel id
+        lookups succeed.
+    """
+
+    def __init__(self, clock, *locations):
+        """ Empty request log """
+        self.clock = clock
+        self.headers = {}
+        self.requests = []
+        self.listing = [{"name": socket.gethostname(), "id": 1}] + \
+            [{"name": location, "id": index + 1} for index, location in enumerate(locations)]
+
+    def mount(self, prefix, adapter):
+        """ Adapters are accepted and ignored """
+
+    def get(self, url, timeout=None):
+        """ Every listing holds this host """
+        # pylint: disable=unused-argument
+        return FakeResponse(200, self.listing)
+
+    def put(self, url, data=None, timeout=None):
+        """ Record the PUT body """
+        # pylint: disable=unused-argument
+        self.requests.append((self.clock.time(), url, data))
+        return FakeResponse(200)
+
+# simulated driver for each name in the sensor registry
+SIMULATED_DRIVERS = {
+    'bme680': FakeBme680,
+    'veml7700': FakeVeml7700,
+}
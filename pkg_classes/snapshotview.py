@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+""" Publish a whole sensor snapshot as a single MQTT message """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import time
+import logging
+
+# CBOR is optional, JSON is used when cbor2 is not installed
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class SnapshotView:
+    """ Combine every reading from a set of sensors, with a timestamp, into one
+        compact retained message on the location snapshot topic.
+    """
+
+    def __init__(self, client, topic, encoding="json"):
+        """ Save the client and topic and select JSON or CBOR encoding """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.topic = topic + "/snapshot"
+        if encoding == "cbor" and cbor2 is None:
+            self.logger.error("cbor2 not installed, snapshots will use JSON")
+            encoding = "json"
+        self.encoding = encoding
+        self.clock = time
+
+    def set_clock(self, clock):
+        """ Replace the time module, for example with a virtual clock """
+        self.clock = clock
+
+    def snapshot(self, sensors):
+        """ Readings and window statistics from every sensor """
+        info = {'timestamp': int(self.clock.time())}
+        statistics = {}
+        for sensor in sensors:
+            for key, value in sensor.dict.items():
+                info[key] = float(value)
+            for key, summary in sensor.statistics.items():
+                statistics[key] = {name: round(value, 3) for name, value in summary.items()}
+        info['statistics'] = statistics
+        return info
+
+    def encode(self, info):
+        """ Compact JSON or CBOR payload """
+        if self.encoding == "cbor":
+            return cbor2.dumps(info)
+        return json.dumps(info, separators=(',', ':'))
+
+    def publish(self, sensors):
+        """ Publish one message holding the whole snapshot """
+        self.client.publish(self.topic, self.encode(self.snapshot(sensors)), 0, True)
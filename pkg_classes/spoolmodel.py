@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+""" Durable store-and-forward spool for MQTT and Django delivery """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import base64
+import json
+import sqlite3
+import threading
+import time
+import logging
+
+import paho.mqtt.client as mqtt
+
+from pkg_classes.metricsmodel import METRICS
+
+class SpoolModel:
+    """ SQLite WAL spool that stands in for the MQTT client. Messages that can
+        not be delivered, and Django PUTs that exhaust their retries, are kept
+        on disk with their timestamp and replayed in order at a bounded rate.
+    """
+
+    def __init__(self, client, path, max_bytes=8*1024*1024, rate=10):
+        """ Open or create the spool database and measure what it holds """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.django = None
+        self.max_bytes = max_bytes
+        self.rate = rate
+        self.evicted = 0
+        self.clock = time
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS spool ("
+                                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "timestamp REAL, kind TEXT, target TEXT, payload BLOB)")
+        self.connection.commit()
+        self.size = self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(target) + LENGTH(payload)), 0) FROM spool").fetchone()[0]
+        self.logger.info("Spool opened with {0} bytes pending".format(self.size))
+
+    def set_clock(self, clock):
+        """ Replace the time module, for example with a virtual clock """
+        self.clock = clock
+
+    def set_django(self, django):
+        """ Django model used to replay spooled PUTs """
+        self.django = django
+
+    def store(self, kind, target, payload):
+        """ Append one undelivered message and evict the oldest when full """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO spool (timestamp, kind, target, payload) VALUES (?, ?, ?, ?)",
+                (self.clock.time(), kind, target, payload))
+            self.size += len(target) + len(payload)
+            self.evict()
+            self.connection.commit()
+
+    def evict(self,):
+        """ Drop the oldest messages until the spool fits in max_bytes """
+        while self.size > self.max_bytes:
+            rows = self.connection.execute(
+                "SELECT id, LENGTH(target) + LENGTH(payload) FROM spool "
+                "ORDER BY id LIMIT 64").fetchall()
+            if not rows:
+                self.size = 0
+                break
+            last_id = rows[0][0]
+            for row_id, row_size in rows:
+                last_id = row_id
+                self.size -= row_size
+                self.evicted += 1
+                if self.size <= self.max_bytes:
+                    break
+            self.connection.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+        if self.evicted:
+            self.logger.warning("Spool full, {0} messages evicted".format(self.evicted))
+            self.evicted = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """ Same signature as the MQTT client publish, spools on failure """
+        if self.client.is_connected():
+            result = self.client.publish(topic, payload, qos, retain)
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                METRICS.inc('diyha_mqtt_publish_total', {'result': 'sent'})
+                return result
+            if self.queued(result, qos):
+                METRICS.inc('diyha_mqtt_publish_total', {'result': 'queued'})
+                return result
+        METRICS.inc('diyha_mqtt_publish_total', {'result': 'spooled'})
+        self.logger.debug("Spooled "+topic)
+        self.store("mqtt", topic, payload)
+        return None
+
+    def queued(self, result, qos):
+        """ paho keeps a QoS 1 or 2 message published while the connection
+            drops and sends it after reconnecting, spooling it as well would
+            deliver it twice
+        """
+        return result.rc == mqtt.MQTT_ERR_NO_CONN and max(qos, getattr(self.client, 'qos', 0)) > 0
+
+    def put(self, url, info):
+        """ Keep a Django PUT that ran out of retries """
+        self.store("django", url, json.dumps(info))
+
+    def replay_mqtt(self, timestamp, topic, payload):
+        """ Replay on <topic>/replay, not retained, so the live value stands """
+        info = {'timestamp': timestamp}
+        try:
+            info['payload'] = payload.decode('utf-8')
+        except UnicodeDecodeError:
+            info['payload_b64'] = base64.b64encode(payload).decode('ascii')
+        result = self.client.publish(topic+"/replay", json.dumps(info), 1, False)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS and not self.queued(result, 1):
+            return False
+        METRICS.inc('diyha_mqtt_publish_total', {'result': 'replayed'})
+        return True
+
+    def replay_django(self, timestamp, url, payload):
+        """ Requeue a PUT unless a newer one has reached the server """
+        if not self.django.online:
+            return False
+        if self.django.delivered.get(url, 0.0) < timestamp:
+            self.django.enqueue(url, json.loads(payload))
+        return True
+
+    def replay(self,):
+        """ Deliver up to rate of the oldest messages, stop at the first failure """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, timestamp, kind, target, payload FROM spool "
+                "ORDER BY id LIMIT ?", (self.rate,)).fetchall()
+        delivered = []
+        for row_id, timestamp, kind, target, payload in rows:
+            if kind == "mqtt":
+                if not self.client.is_connected() or \
+                        not self.replay_mqtt(timestamp, target, payload):
+                    break
+            elif self.django is None or not self.replay_django(timestamp, target, payload):
+                break
+            delivered.append((row_id, len(target) + len(payload)))
+        if delivered:
+            with self.lock:
+                self.connection.executemany("DELETE FROM spool WHERE id = ?",
+                                            [(row_id,) for row_id, _ in delivered])
+                self.connection.commit()
+                self.size -= sum(row_size for _, row_size in delivered)
+            self.logger.info("Replayed {0} spooled messages".format(len(delivered)))
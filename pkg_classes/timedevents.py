@@ -23,58 +23,97 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import time
+import contextlib
+
+from pkg_classes.metricsmodel import METRICS
+
+# sensor outputs sent to the Django environment API
+ENVIRONMENT_FIELDS = ('temperature', 'humidity', 'gas', 'pressure', 'lux')
 
 class TimedEvents:
-    """ timed event handler """
+    """ timed event handler, the events are jobs in a Scheduler """
 
-    def __init__(self, client, location_name, django, bme680, veml7700):
-        """ Initialize 10 minute measurements intervals and a calibration """
-        self.timed_events_dictionary = {
-            "01": {"method": self.execute_timed_event, "executed": False},
-            "11": {"method": self.execute_timed_event, "executed": False},
-            "21": {"method": self.execute_timed_event, "executed": False},
-            "31": {"method": self.execute_timed_event, "executed": False},
-            "41": {"method": self.execute_timed_event, "executed": False},
-            "51": {"method": self.execute_timed_event, "executed": False}
-            }
+    def __init__(self, client, location_name, django, sensors):
+        """ Save the sensors and the Django model used by the events """
         self.client = client
         self.location_name = location_name
         self.django = django
-        self.bme680 = bme680
-        self.veml7700 = veml7700
-        
+        self.sensors = sensors
+        self.engine = None
+        self.publish_mode = "fields"
+        self.snapshot = None
+        # context manager around the work done for this location
+        self.meter = contextlib.nullcontext()
+
+    def schedule(self, scheduler, minutes, period, calibrate_minute, offset=0.0):
+        """ Publish at minutes past each hour, or every period seconds when
+            period is set, and calibrate once an hour at calibrate_minute.
+            Every event is shifted by the node's phase offset in seconds.
+        """
+        # named per location so gateway instances keep their own jobs
+        # and jitter statistics
+        publish_name = "timed event "+self.location_name
+        if period:
+            scheduler.add_periodic(publish_name, period, self.execute_timed_event,
+                                   delay=period + offset % period)
+        else:
+            scheduler.add_cron(publish_name, minutes, self.execute_timed_event,
+                               offset=offset)
+        scheduler.add_cron("calibration "+self.location_name, (calibrate_minute,),
+                           self.calibrate_sensors, offset=offset)
+
+    def set_engine(self, engine):
+        """ Hand publishing, Django updates and calibration to the sampling engine """
+        self.engine = engine
+
+    def dispatch(self, name, method, lane):
+        """ Run slow work on an engine lane or inline when there is no engine """
+        if self.engine is None:
+            method()
+        else:
+            self.engine.submit(name, method, lane)
+
+    def set_meter(self, meter):
+        """ Account the averaging, publishing and Django work to a CpuMeter """
+        self.meter = meter
+
+    def set_publish_mode(self, mode, snapshot):
+        """ Publish retained per-field topics, one batched snapshot or both """
+        self.publish_mode = mode
+        self.snapshot = snapshot
+
+    def publish_samples(self,):
+        ''' Publish the latest averages from every sensor. '''
+        with self.meter, METRICS.timer('publish'):
+            for sensor in self.sensors:
+                if self.publish_mode == "batch":
+                    sensor.format_samples()
+                else:
+                    sensor.publish_samples()
+            if self.publish_mode != "fields":
+                self.snapshot.publish(self.sensors)
+
     def django_update(self,):
         ''' PUT environment data to the Django web server '''
-        info = {'name': self.location_name}
-        info['temperature'] = self.bme680.dict['temperature']
-        info['humidity'] = self.bme680.dict['humidity']
-        info['gas'] = self.bme680.dict['gas']
-        info['pressure'] = self.bme680.dict['pressure']
-        info['lux'] = self.veml7700.dict['lux']
-        self.django.put_environment(info)
+        with self.meter:
+            info = {'name': self.location_name}
+            for sensor in self.sensors:
+                for key in ENVIRONMENT_FIELDS:
+                    if key in sensor.dict:
+                        info[key] = sensor.dict[key]
+            self.django.put_environment(info)
 
     def execute_timed_event(self,):
         ''' Execute timed event to compute averages and them publish. '''
-        self.bme680.average_samples()
-        self.bme680.publish_samples()
-        self.veml7700.average_samples()
-        self.veml7700.publish_samples()
-        self.django_update()
-
-    def last_timed_event(self,):
-        ''' Reset the timed events dictionary to restart the process. '''
-        for key in self.timed_events_dictionary:
-            self.timed_events_dictionary[key]["executed"] = False
-        # calibrate gas sensor every hour
-        self.bme680.calibrate()
+        with self.meter, METRICS.timer('average'):
+            for sensor in self.sensors:
+                sensor.average_samples()
+        # the io lane runs jobs in order so Django sees the new values, the
+        # location keeps gateway instances from skipping each other's jobs
+        self.dispatch("publish "+self.location_name, self.publish_samples, "io")
+        self.dispatch("django "+self.location_name, self.django_update, "io")
 
-    def check_for_timed_events(self,):
-        ''' see if its time to capture and publish measurements. '''
-        minute_string = time.strftime("%M")
-        if minute_string == "55":
-            self.last_timed_event()
-        elif minute_string in self.timed_events_dictionary:
-            if not self.timed_events_dictionary[minute_string]["executed"]:
-                self.timed_events_dictionary[minute_string]["executed"] = True
-                self.timed_events_dictionary[minute_string]["method"]()
\ No newline at end of file
+    def calibrate_sensors(self,):
+        ''' Calibrate every sensor in the background once an hour. '''
+        for sensor in self.sensors:
+            self.dispatch("calibrate "+sensor.label, sensor.run_calibration, "calibrate")
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+""" MQTT topic dispatch through a wildcard trie to per-handler worker queues """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import queue
+import threading
+import logging
+
+# messages waiting per handler before new ones are dropped
+QUEUE_SIZE = 32
+
+# distinct unknown topics remembered so each is only logged once
+UNKNOWN_LIMIT = 256
+
+class TopicHandler:
+    """ One handler with a bounded queue and its own worker thread, so a
+        slow handler only delays its own messages.
+    """
+
+    def __init__(self, logger, pattern, method, queue_size):
+        """ Start the worker for method """
+        self.logger = logger
+        self.pattern = pattern
+        self.method = method
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.worker = threading.Thread(target=self.run_worker, daemon=True,
+                                       name="topic "+pattern)
+        self.worker.start()
+
+    def put(self, msg):
+        """ Queue a message without blocking the MQTT network thread """
+        try:
+            self.queue.put_nowait(msg)
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning(self.pattern+" queue full, {0} messages dropped".format(
+                self.dropped))
+
+    def run_worker(self,):
+        """ Call the handler for each queued message in order """
+        while True:
+            msg = self.queue.get()
+            try:
+                self.method(msg)
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception(self.pattern+" handler failed on "+msg.topic)
+
+class TopicDispatcher:
+    """ Matches topics against subscriptions with + and # wildcards using a
+        trie of topic levels and hands each message to every matching handler.
+    """
+
+    def __init__(self):
+        """ Empty trie, a node is [children, handlers] """
+        self.logger = logging.getLogger(__name__)
+        self.root = [{}, []]
+        self.handlers = {}
+        self.unknown = set()
+
+    def register(self, pattern, method, queue_size=QUEUE_SIZE):
+        """ Call method for every message matching the subscription pattern """
+        levels = pattern.split("/")
+        if "#" in levels[:-1] or any(("+" in level or "#" in level) and len(level) > 1
+                                     for level in levels):
+            raise ValueError("invalid subscription "+pattern)
+        handler = TopicHandler(self.logger, pattern, method, queue_size)
+        node = self.root
+        for level in levels:
+            node = node[0].setdefault(level, [{}, []])
+        node[1].append(handler)
+        self.handlers.setdefault(pattern, []).append(handler)
+        return handler
+
+    def register_all(self, dictionary):
+        """ Register {pattern: {"method": method, "queue": size}} entries """
+        for pattern, entry in dictionary.items():
+            self.register(pattern, entry["method"], entry.get("queue", QUEUE_SIZE))
+
+    def get_subscriptions(self,):
+        """ Every registered pattern, subscribed again after a reconnect """
+        return list(self.handlers)
+
+    def match(self, topic):
+        """ Handlers whose pattern matches topic """
+        levels = topic.split("/")
+        matched = []
+        nodes = [self.root]
+        for depth, level in enumerate(levels):
+            following = []
+            for node in nodes:
+                children = node[0]
+                # wildcards never match topics such as $SYS at the first level
+                wildcards = not (depth == 0 and level.startswith("$"))
+                if wildcards and "#" in children:
+                    matched.extend(children["#"][1])
+                if level in children:
+                    following.append(children[level])
+                if wildcards and "+" in children:
+                    following.append(children["+"])
+            nodes = following
+        for node in nodes:
+            matched.extend(node[1])
+            # a/# also matches a itself
+            if "#" in node[0]:
+                matched.extend(node[0]["#"][1])
+        return matched
+
+    def dispatch(self, msg):
+        """ Queue msg for every matching handler, log topics nobody handles """
+        handlers = self.match(msg.topic)
+        if not handlers:
+            if msg.topic not in self.unknown and len(self.unknown) < UNKNOWN_LIMIT:
+                self.unknown.add(msg.topic)
+                self.logger.warning("No handler for topic "+msg.topic)
+            return
+        for handler in handlers:
+            handler.put(msg)
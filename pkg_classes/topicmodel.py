@@ -24,6 +24,7 @@
 # THE SOFTWARE.
 
 import socket
+import zlib
 
 class TopicModel:
     """ Location_topic initializer waits for MQTT broker logic to pass location and
@@ -51,6 +52,13 @@ class TopicModel:
         """ The location topic is used to manage multiple devices. """
         return self.location_topic
         
+    def get_phase_offset(self, budget):
+        """ Stable offset between 0 and budget seconds hashed from the host and
+            location, so a fleet spreads its publishing across the interval.
+        """
+        node = (self.status_topic + " " + self.location_topic).encode('utf-8')
+        return budget * zlib.crc32(node) / 4294967296.0
+
     def get_location_name(self,):
         """ The location topic is used to manage multiple devices. """
         return self.location_name
\ No newline at end of file
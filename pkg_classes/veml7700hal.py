@@ -23,73 +23,62 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-# Many attributes for this complex sensor.
-# pylint: disable=too-many-instance-attributes
+from pkg_classes.sensorhal import SensorHAL, get_i2c
 
-import time
-import logging
-import logging.config
+# command line gain and integration time to driver constant names
+GAINS = {'1/8': 'ALS_GAIN_1_8', '1/4': 'ALS_GAIN_1_4', '1': 'ALS_GAIN_1', '2': 'ALS_GAIN_2'}
+INTEGRATION_TIMES = {25: 'ALS_25MS', 50: 'ALS_50MS', 100: 'ALS_100MS',
+                     200: 'ALS_200MS', 400: 'ALS_400MS', 800: 'ALS_800MS'}
 
-import board
-import busio
-import adafruit_veml7700
+class Veml7700HAL(SensorHAL):
+    """ Idle or sleep pattern """
 
-i2c = busio.I2C(board.SCL, board.SDA)
-SENSOR = adafruit_veml7700.VEML7700(i2c)
+    name = 'veml7700'
 
-class Veml7700HAL:
-    """ Idle or sleep pattern """
+    # a 16 bit count, lux up to direct sunlight at the lowest gain
+    limits = {'ambientLight': (0, 65535), 'lux': (0.0, 140000.0)}
+    floors = {'ambientLight': 100.0, 'lux': 5.0}
 
-    def __init__(self, logging_file, client, topic):
+    def __init__(self, client, topic):
         """ create initial conditions and saving display and I2C lock """
-        logging.config.fileConfig(fname=logging_file,
-            disable_existing_loggers=False)
-        # Get the logger specified in the file
-        self.logger = logging.getLogger(__name__)
-        self.logger.info('Application started')
-        self.client = client
-        self.topic = topic
-        self.data = {}
-        self.averages = {
-            'ambientLight': 0.0,
-            'lux': 0.0
-        }
-        self.dict = {
-            'ambientLight': "0.0",
-            'lux': "0.0"
-        }
-        self.samples = 0
-        self.new_samples()
+        super().__init__(client, topic,
+                         ('ambientLight', 'lux'), ('ambientLight', 'lux'))
+        # None keeps the driver default gain and integration time
+        self.gain = None
+        self.integration_time = None
+        # lux per count for the current gain and integration time
+        self.resolution = None
 
-    def new_samples(self,):
-        """ initialize a new set of samples """
-        self.data = {
-            'ambientLight': 0.0,
-            'lux': 0.0
-        }
-        self.samples = 0
+    def open_sensor(self,):
+        """ create the VEML7700 driver on the shared I2C bus """
+        import adafruit_veml7700 # pylint: disable=import-outside-toplevel
+        return adafruit_veml7700.VEML7700(get_i2c(*self.bus))
 
-    def collect_sample(self,):
-        """ capture one data sample """
-        self.data['ambientLight'] += SENSOR.light
-        self.data['lux'] += SENSOR.lux
-        self.samples += 1
+    def configure(self, config):
+        """ apply the sampling and driver settings """
+        super().configure(config)
+        self.gain, self.integration_time = config.get_veml7700_settings()
+        if self.sensor is not None:
+            self.apply_settings(self.sensor)
 
-    def average_samples(self,):
-        """ compute averages based on number of samples """
-        if self.samples > 0:
-            self.averages['ambientLight'] = self.data['ambientLight'] / self.samples
-            self.averages['lux'] = self.data['lux'] / self.samples
-        self.new_samples()
+    def apply_settings(self, sensor):
+        """ write gain and integration time to the driver """
+        if self.gain is not None:
+            sensor.light_gain = getattr(type(sensor), GAINS[self.gain])
+        if self.integration_time is not None:
+            sensor.light_integration_time = getattr(
+                type(sensor), INTEGRATION_TIMES[self.integration_time])
+        # gain and integration time only change here, so the resolution is
+        # read once instead of with every lux reading
+        self.resolution = sensor.resolution() if hasattr(sensor, 'resolution') else None
 
-    def publish_samples(self,):
-        """ publish data """
-        info = "{0:.1f}".format(self.averages['ambientLight'])
-        self.client.publish(self.topic+"/ambientLight", str(info), 0, True)
-        self.dict["ambientLight"] = info
-        info = "{0:.1f}".format(self.averages['lux'])
-        self.client.publish(self.topic+"/lux", str(info), 0, True)
-        self.dict["lux"] = info
+    def read_sample(self, sensor):
+        """ capture one data sample, lux is scaled from the same reading """
+        if self.resolution is None:
+            return {'ambientLight': sensor.light, 'lux': sensor.lux}
+        # the driver's lux reads light, gain and integration time again
+        light = sensor.light
+        return {'ambientLight': light, 'lux': light * self.resolution}
 
 if __name__ == '__main__':
     exit()
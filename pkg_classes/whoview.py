@@ -25,16 +25,13 @@
 
 import socket
 import logging
-import logging.config
 
 class WhoView:
     """ Who controller handles  MQTT broker messsages for diy/system/who ON or OFF.
     """
 
-    def __init__(self, logging_file):
+    def __init__(self):
         """ Create two topics for this application. """
-        logging.config.fileConfig(fname=logging_file, disable_existing_loggers=False)
-        # Get the logger specified in the file
         self.logger = logging.getLogger(__name__)
         host_name = socket.gethostname()
         self.default_who_message = host_name
@@ -24,19 +24,18 @@
 # THE SOFTWARE.
 
 import os
-import time
+import signal
+import sys
 import logging
-import logging.config
-
-# imported third party classes
-
-import paho.mqtt.client as mqtt
-from pkg_classes.bme680hal import Bme680HAL
-from pkg_classes.veml7700hal import Veml7700HAL
 
 # imported DIYHA classes
 
-from pkg_classes.timedevents import TimedEvents
+from pkg_classes.samplingengine import SamplingEngine
+from pkg_classes.sensornode import SensorNode
+from pkg_classes.topicdispatcher import TopicDispatcher
+from pkg_classes.metricsmodel import METRICS
+from pkg_classes.connectionmodel import ConnectionModel
+from pkg_classes.loggingmodel import setup_logging, use_json_format
 
 # DIYHA standard classes
 from pkg_classes.topicmodel import TopicModel
@@ -47,29 +46,33 @@ from pkg_classes.djangomodel import DjangoModel
 # Start logging and enable imported classes to log appropriately.
 
 LOGGING_FILE = '/usr/local/sensor/logging.ini'
-logging.config.fileConfig( fname=LOGGING_FILE, disable_existing_loggers=False )
+setup_logging(LOGGING_FILE)
 LOGGER = logging.getLogger(__name__)
 LOGGER.info('Application started')
 
 # get the command line arguments
 
-CONFIG = ConfigModel(LOGGING_FILE)
+CONFIG = ConfigModel()
+if CONFIG.get_log_json():
+    use_json_format()
 
-# Location is used to create the topics and Django urls
+# Location is used to create the topics and Django urls, a gateway uses
+# its first location here and adds the others
 
 TOPIC = TopicModel()  # Location MQTT topic
 TOPIC.set(CONFIG.get_location())
 
-# setup web server updates
+# setup web server updates, ids are looked up in the background
 
-DJANGO = DjangoModel(LOGGING_FILE)
+DJANGO = DjangoModel()
+DJANGO.set_cache(*CONFIG.get_django_cache())
 DJANGO.set_urls(CONFIG.get_django_api_url(), TOPIC.get_location_name())
 
 # Set up who message handler from MQTT broker and wait for client.
 
-WHO = WhoView(LOGGING_FILE)
+WHO = WhoView()
 
-# process system messages: calibrate sensors and location information.
+# process system messages: location information, calibrate is a CalibrationJob.
 
 def system_message(msg):
     """ process system messages"""
@@ -81,81 +84,50 @@ def system_message(msg):
             WHO.turn_off()
 
 
-# use a dispatch model for the subscriptions
+# use a dispatch model for the subscriptions, + and # wildcards are allowed
+# and each handler has its own queue so a slow one can not stall the others
 TOPIC_DISPATCH_DICTIONARY = {
-    "diy/system/calibrate":
-        {"method":system_message},
     "diy/system/who":
         {"method":system_message},
     }
 
-
-# The callback for when the client receives a CONNACK response from the server.
-# def on_connect(client, userdata, flags, rc_msg):
-def on_connect(client, userdata, flags, rc_msg):
-    """ Subscribing in on_connect() means that if we lose the connection and
-        reconnect then subscriptions will be renewed.
-    """
-
-    #pylint: disable=unused-argument
-
-    client.subscribe("diy/system/calibrate", 1)
-    client.subscribe("diy/system/who", 1)
-
-
-def on_disconnect(client, userdata, rc_msg):
-    """ Subscribing on_disconnect() tilt """
-
-    #pylint: disable=unused-argument
-
-    client.connected_flag = False
-    client.disconnect_flag = True
-
-
-# The callback for when a PUBLISH message is received from the server.
-
-def on_message(client, userdata, msg):
-    """ dispatch to the appropriate MQTT topic handler """
-
-    #pylint: disable=unused-argument
-
-    TOPIC_DISPATCH_DICTIONARY[msg.topic]["method"](msg)
+DISPATCHER = TopicDispatcher()
+DISPATCHER.register_all(TOPIC_DISPATCH_DICTIONARY)
 
 
 if __name__ == '__main__':
     #Start utility threads, setup MQTT handlers then wait for timed events
 
-    CLIENT = mqtt.Client()
-    CLIENT.on_connect = on_connect
-    CLIENT.on_disconnect = on_disconnect
-    CLIENT.on_message = on_message
+    CLIENT = ConnectionModel(CONFIG.get_broker(), TOPIC.get_status_topic(),
+                             *CONFIG.get_connection())
 
     # initilze the Who client for publishing.
 
     WHO.set_client(CLIENT)
 
-    # command line argument for the switch mode - motion activated is the default
-
-    CLIENT.connect(CONFIG.get_broker(), 1883, 60)
-    CLIENT.loop_start()
-    
-    # let MQTT stuff initialize
+    # the spool, history, locations, queries, remote calibration and every
+    # scheduled job, sampling runs on the event loop and slow work runs on
+    # executor lanes
 
-    time.sleep(2) 
+    ENGINE = SamplingEngine()
+    NODE = SensorNode(CONFIG, CLIENT, DJANGO, DISPATCHER, ENGINE)
 
-    # start the sensors and the timer which controls averaging and publishing
+    # optionally serve queue depths, sensor values and stage timings
 
-    BME680 = Bme680HAL(LOGGING_FILE, CLIENT, TOPIC.get_location_topic())
-    BME680.calibrate()
+    if CONFIG.get_metrics() is not None:
+        METRICS.add_collector(NODE.collect_metrics)
+        METRICS.serve(CONFIG.get_metrics())
 
-    VEML7700 = Veml7700HAL(LOGGING_FILE, CLIENT, TOPIC.get_location_topic())
+    # connect once every handler is registered so the node subscribes them,
+    # readings are spooled until the broker can be reached
 
-    TIMER = TimedEvents(CLIENT, TOPIC.get_location_name(), DJANGO, BME680, VEML7700)
+    CLIENT.start()
 
-    # loop forever checking for timed events
+    # run forever checking for samples and timed events, a clean stop
+    # publishes offline in place of the last will
 
-    while True:
-        time.sleep(10.0)
-        BME680.collect_sample()
-        VEML7700.collect_sample()
-        TIMER.check_for_timed_events()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        ENGINE.start()
+    finally:
+        CLIENT.stop()
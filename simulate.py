@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+""" Replay the DIYHA sensor pipeline on simulated hardware at virtual time """
+
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+from pkg_classes.configmodel import ConfigModel
+from pkg_classes.loggingmodel import setup_logging
+from pkg_classes.simulatednode import SimulatedNode
+from pkg_classes.simulatedsensors import VirtualClock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOGGING_FILE = os.path.join(HERE, 'simulation', 'logging.ini')
+
+# 2021-01-01 00:00:00 UTC, fixed so every replay sees the same calendar
+START_TIME = 1609459200.0
+
+# node settings used when no sensor.py options are passed through
+DEFAULT_ARGV = ['--mqtt', 'simulated', '--location', 'diy/simulated/room',
+                '--webserver', 'simulated.local', '--spool', ':memory:',
+                '--calibration-state', '']
+
+def matches(expected, actual):
+    """ Compare records, numbers only need to agree to the third decimal """
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        return math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1.1e-3)
+    if isinstance(expected, list) and isinstance(actual, list):
+        return len(expected) == len(actual) and \
+            all(matches(left, right) for left, right in zip(expected, actual))
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        return expected.keys() == actual.keys() and \
+            all(matches(expected[key], actual[key]) for key in expected)
+    return expected == actual
+
+def compare(expected, actual):
+    """ Index of the first differing record, or None when they match """
+    for index, (left, right) in enumerate(zip(expected, actual)):
+        if not matches(left, right):
+            return index
+    if len(expected) != len(actual):
+        return min(len(expected), len(actual))
+    return None
+
+if __name__ == '__main__':
+    setup_logging(LOGGING_FILE)
+    PARSER = argparse.ArgumentParser('Simulated sensor replay, other options go to sensor.py')
+    PARSER.add_argument('--days', type=float, default=1.0, help='Virtual days to replay')
+    PARSER.add_argument('--seed', type=int, default=1, help='Sensor noise seed')
+    PARSER.add_argument('--golden', help='Golden output file to compare against')
+    PARSER.add_argument('--record', action='store_true', help='Write the golden file instead')
+    ARGS, NODE_ARGV = PARSER.parse_known_args()
+
+    CONFIG = ConfigModel(DEFAULT_ARGV + NODE_ARGV)
+    CLOCK = VirtualClock(START_TIME)
+    NODE = SimulatedNode(CONFIG, CLOCK, ARGS.seed)
+
+    STARTED = time.perf_counter()
+    NODE.run(ARGS.days * 86400.0)
+    ELAPSED = time.perf_counter() - STARTED
+    RECORDS = NODE.records()
+
+    SUMMARY = {
+        'virtual_seconds': ARGS.days * 86400.0,
+        'wall_seconds': round(ELAPSED, 3),
+        'speedup': round(ARGS.days * 86400.0 / ELAPSED),
+        'messages': len(NODE.client.messages),
+        'puts': len(NODE.session.requests)
+    }
+    if ARGS.golden is not None and ARGS.record:
+        with open(ARGS.golden, 'w') as golden:
+            json.dump(RECORDS, golden, separators=(',', ':'))
+            golden.write('\n')
+        SUMMARY['golden'] = 'recorded'
+    elif ARGS.golden is not None:
+        with open(ARGS.golden) as golden:
+            DIFFERENCE = compare(json.load(golden), RECORDS)
+        SUMMARY['golden'] = 'match' if DIFFERENCE is None else 'differs at record '+str(DIFFERENCE)
+    print(json.dumps(SUMMARY))
+    sys.exit(1 if SUMMARY.get('golden', '').startswith('differs') else 0)
@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+""" Tests of the Hampel outlier filter """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+
+from pkg_classes.samplebuffer import HampelFilter
+
+# a steady reading with a little noise
+STEADY = [10.0, 11.0, 10.0, 12.0, 10.0, 11.0, 10.0]
+
+class HampelFilterTest(unittest.TestCase):
+    """ Spikes are rejected, lasting changes pass through """
+
+    def setUp(self,):
+        """ A filter with the default window and threshold, full of steady readings """
+        self.outliers = HampelFilter(7, 3.0, 5.0)
+        for value in STEADY:
+            self.assertTrue(self.outliers.check(value))
+
+    def test_isolated_spike_is_rejected(self,):
+        """ A lone spike is rejected and the readings after it are kept """
+        self.assertFalse(self.outliers.check(500.0))
+        self.assertTrue(self.outliers.check(11.0))
+        self.assertTrue(self.outliers.check(10.0))
+
+    def test_step_up_passes_after_one_sample(self,):
+        """ Switching a light on is accepted from its second reading """
+        accepted = [self.outliers.check(400.0) for _ in range(8)]
+        self.assertTrue(all(accepted[1:]))
+
+    def test_step_down_passes_after_one_sample(self,):
+        """ Switching it off again is accepted from its second reading """
+        for _ in range(8):
+            self.outliers.check(400.0)
+        accepted = [self.outliers.check(10.0) for _ in range(8)]
+        self.assertTrue(all(accepted[1:]))
+
+    def test_alternating_spikes_are_rejected(self,):
+        """ Spikes on opposite sides of the median do not confirm each other """
+        self.assertFalse(self.outliers.check(500.0))
+        self.assertFalse(self.outliers.check(-500.0))
+        self.assertTrue(self.outliers.check(10.0))
+
+if __name__ == '__main__':
+    unittest.main()
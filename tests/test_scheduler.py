@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+""" Tests of the minute-of-hour scheduling """
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 parttimehacker@gmail.com
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import unittest
+
+from pkg_classes.scheduler import Scheduler
+from pkg_classes.simulatedsensors import VirtualClock
+
+# 2021-01-01 10:00:00 UTC
+HOUR = 1609495200.0
+
+class NextWallTest(unittest.TestCase):
+    """ The first slot after a time is found wherever the offset moves it """
+
+    def setUp(self,):
+        """ A scheduler on a virtual clock """
+        self.scheduler = Scheduler(VirtualClock(HOUR))
+
+    def next_wall(self, minutes, offset, after):
+        """ Next slot of a job added with minutes and offset """
+        job = self.scheduler.add_cron("job", minutes, lambda: None, offset=offset)
+        return self.scheduler.next_wall(job, after)
+
+    def test_negative_offset_before_the_hour(self,):
+        """ The top of the hour slot moved into the previous hour """
+        self.assertEqual(self.next_wall((0,), -90.0, HOUR - 120.0), HOUR - 90.0)
+        self.assertEqual(self.next_wall((0,), -90.0, HOUR - 60.0), HOUR + 3510.0)
+
+    def test_negative_offset_after_the_hour(self,):
+        """ Just past the hour the next slot is in the following hour """
+        self.assertEqual(self.next_wall((0, 30), -90.0, HOUR + 10.0), HOUR + 1710.0)
+
+    def test_offset_into_the_next_hour(self,):
+        """ A slot of the previous hour moved past the hour is not skipped """
+        self.assertEqual(self.next_wall((50,), 900.0, HOUR + 120.0), HOUR + 300.0)
+
+    def test_offset_of_more_than_an_hour(self,):
+        """ Offsets longer than an hour still give the first later slot """
+        self.assertEqual(self.next_wall((0,), 4000.0, HOUR + 10.0), HOUR + 400.0)
+        self.assertEqual(self.next_wall((0,), -4000.0, HOUR + 10.0), HOUR + 3200.0)
+
+if __name__ == '__main__':
+    unittest.main()